@@ -1,8 +1,9 @@
 import logging
 import os
+import asyncio
 from azure.ai.textanalytics import TextAnalyticsClient
 from azure.core.credentials import AzureKeyCredential
-import azure.functions as func
+from azurefunctions.extensions.http.fastapi import Request, Response
 
 endpoint = os.getenv("TEXT_ANALYTICS_ENDPOINT")
 subscription_key = os.getenv("TEXT_ANALYTICS_KEY")
@@ -13,10 +14,10 @@ def authenticate_client():
         endpoint=endpoint, credential=ta_credential)
     return text_analytics_client
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    text = req.params.get('text')
+async def main(req: Request) -> Response:
+    text = req.query_params.get('text')
     if not text:
-        return func.HttpResponse(
+        return Response(
             "Please pass a text on the query string",
             status_code=400
         )
@@ -24,7 +25,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     client = authenticate_client()
 
     try:
-        response = client.detect_language(documents=[{"id": "1", "text": text}])
+        response = await asyncio.to_thread(client.detect_language, documents=[{"id": "1", "text": text}])
         language_code = response[0].primary_language.iso6391_name
 
         language_to_voice = {
@@ -41,7 +42,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             "ar": "ar-AE"
         }
 
-        return func.HttpResponse(language_to_voice.get(language_code, "en-US"), status_code=200)
+        return Response(language_to_voice.get(language_code, "en-US"), status_code=200)
     except Exception as e:
         logging.error(f"Error detecting language: {e}")
-        return func.HttpResponse("Error detecting language", status_code=500)
\ No newline at end of file
+        return Response("Error detecting language", status_code=500)
\ No newline at end of file
@@ -0,0 +1,38 @@
+import azure.functions as func
+
+from azurefunctions.extensions.http.fastapi import Request, Response
+
+import message
+import detectLanguage
+import getIceServerToken
+import getSpeechToken
+
+# Python v2 programming model with the HTTP streaming extension (azurefunctions-extensions-http-fastapi),
+# so that /api/message?stream=1 can send its server-sent events while the answer is generated.
+# Each function keeps its code in its own package, the routes are the former function names.
+# Needs the app setting PYTHON_ENABLE_INIT_INDEXING=1.
+app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
+
+
+@app.function_name(name="message")
+@app.route(route="message", methods=[func.HttpMethod.GET, func.HttpMethod.POST])
+async def message_function(req: Request) -> Response:
+    return await message.main(req)
+
+
+@app.function_name(name="detectLanguage")
+@app.route(route="detectLanguage", methods=[func.HttpMethod.GET, func.HttpMethod.POST])
+async def detect_language_function(req: Request) -> Response:
+    return await detectLanguage.main(req)
+
+
+@app.function_name(name="getIceServerToken")
+@app.route(route="getIceServerToken", methods=[func.HttpMethod.GET, func.HttpMethod.POST])
+async def get_ice_server_token_function(req: Request) -> Response:
+    return await getIceServerToken.main(req)
+
+
+@app.function_name(name="getSpeechToken")
+@app.route(route="getSpeechToken", methods=[func.HttpMethod.GET, func.HttpMethod.POST])
+async def get_speech_token_function(req: Request) -> Response:
+    return await getSpeechToken.main(req)
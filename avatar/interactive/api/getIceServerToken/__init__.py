@@ -1,28 +1,29 @@
 import logging
+import asyncio
 import requests
 import os
 import json
 
-import azure.functions as func
+from azurefunctions.extensions.http.fastapi import Request, Response
 
 # Define subscription key and region
 subscription_key = os.getenv("AZURE_SPEECH_API_KEY")
 region = os.getenv("AZURE_SPEECH_REGION")
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+async def main(req: Request) -> Response:
     logging.info('Python HTTP trigger function processed a request.')
 
     # Define token endpoint
     token_endpoint = f"https://{region}.tts.speech.microsoft.com/cognitiveservices/avatar/relay/token/v1"
 
     # Make HTTP request with subscription key as header
-    response = requests.get(token_endpoint, headers={"Ocp-Apim-Subscription-Key": subscription_key})
+    response = await asyncio.to_thread(requests.get, token_endpoint, headers={"Ocp-Apim-Subscription-Key": subscription_key})
 
     if response.status_code == 200:
-        return func.HttpResponse(
-            body= json.dumps(response.json()),
+        return Response(
+            json.dumps(response.json()),
             status_code=200,
-            headers={"Content-Type": "application/json"}
+            media_type="application/json"
         )
     else:
-        return func.HttpResponse(response.status_code)
+        return Response(status_code=response.status_code)
@@ -1,27 +1,28 @@
 import logging
+import asyncio
 import requests
 import os
 
-import azure.functions as func
+from azurefunctions.extensions.http.fastapi import Request, Response
 
 # Define subscription key and region
 subscription_key = os.getenv("AZURE_SPEECH_API_KEY")
 region = os.getenv("AZURE_SPEECH_REGION")
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+async def main(req: Request) -> Response:
     logging.info('Python HTTP trigger function processed a request.')
 
     # Define token endpoint
     token_endpoint = f"https://{region}.api.cognitive.microsoft.com/sts/v1.0/issueToken"
 
     # Make HTTP request with subscription key as header
-    response = requests.post(token_endpoint, headers={"Ocp-Apim-Subscription-Key": subscription_key})
+    response = await asyncio.to_thread(requests.post, token_endpoint, headers={"Ocp-Apim-Subscription-Key": subscription_key})
 
     if response.status_code == 200:
         access_token = response.text
-        return func.HttpResponse(
+        return Response(
              access_token,
              status_code=200
         )
     else:
-        return func.HttpResponse(response.status_code)
+        return Response(status_code=response.status_code)
@@ -1,17 +1,30 @@
 import logging
 import os
+import asyncio
+import re
 import json
+import hashlib
+import threading
 import requests
 from datetime import datetime, timedelta
 import pyodbc
 
-import azure.functions as func
+from azurefunctions.extensions.http.fastapi import Request, Response, StreamingResponse
+
+from .sql_pool import ConnectionPool
+from .product_index import ProductIndex
+from .answer_cache import AnswerCache
 
 search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
 search_key = os.getenv("AZURE_SEARCH_API_KEY") 
 search_api_version = '2023-07-01-Preview'
 search_index_name = os.getenv("AZURE_SEARCH_INDEX")
 
+# local product search: get_product_information searches the catalog file in memory instead of the search index
+local_product_search = os.getenv("LOCAL_PRODUCT_SEARCH", "0") == "1"
+# the default is the copy of data/product-catalog-vectors.json deployed with this function
+product_catalog_file = os.getenv("PRODUCT_CATALOG_FILE", os.path.join(os.path.dirname(__file__), "product-catalog-vectors.json"))
+
 AOAI_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
 AOAI_key = os.getenv("AZURE_OPENAI_API_KEY")
 AOAI_api_version = os.getenv("AZURE_OPENAI_API_VERSION")
@@ -28,11 +41,42 @@ blob_sas_url = os.getenv("BLOB_SAS_URL")
 server_connection_string = f"Driver={{ODBC Driver 17 for SQL Server}};Server=tcp:{sql_db_server},1433;Uid={sql_db_user};Pwd={sql_db_password};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;"
 database_connection_string = server_connection_string + f"Database={sql_db_name};"
 
+sql_pool_max_size = int(os.getenv("SQL_POOL_MAX_SIZE", "5"))
+sql_pool_max_idle_seconds = int(os.getenv("SQL_POOL_MAX_IDLE_SECONDS", "300"))
+
+# connection pools by connection string, kept for the lifetime of the function host
+sql_pools = {}
+sql_pools_lock = threading.Lock()
+
+# in-memory index of product_catalog_file, loaded at cold start so that the first request doesn't pay for it
+product_index = None
+if local_product_search:
+    if not os.path.exists(product_catalog_file):
+        raise FileNotFoundError(f"LOCAL_PRODUCT_SEARCH is on but there is no product catalog at {product_catalog_file}, set PRODUCT_CATALOG_FILE")
+    product_index = ProductIndex.from_file(product_catalog_file, vector_field="description_vector")
+
+# order IDs come from the dbo.OrderIds sequence, created on first order if the database doesn't have it
+order_sequence_ready = False
+
+# semantic answer cache: a question close enough to an earlier one, in the same context, gets the earlier answer without any completion
+answer_cache_enabled = os.getenv("ANSWER_CACHE", "0") == "1"
+answer_cache = AnswerCache(
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+    ttl_seconds=int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600")),
+    max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000")),
+)
+
+# answers that depend on the customer account are never cached
+account_functions = {"get_bonus_points", "get_order_details", "order_product"}
+
 # font color adjustments
 blue, end_blue = '\033[36m', '\033[0m'
 
 place_orders = False
 
+# a sentence ends at . ! ? (followed by a space) or at CJK sentence punctuation
+sentence_end_regex = re.compile(r'[.!?](?=\s)|[。！？]')
+
 functions = [
     {
         "name": "get_bonus_points",
@@ -100,104 +144,282 @@ functions = [
     }
 ]
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+async def main(req: Request) -> Response:
     logging.info('Python HTTP trigger function processed a request.')
 
-    messages = json.loads(req.get_body())
+    messages = json.loads(await req.body())
+
+    # streaming mode: server-sent events with tokens and sentence-sized chunks, sent as they are generated, see stream_chat
+    # the generator is synchronous, the response iterates it in a worker thread
+    if req.query_params.get('stream', '0').lower() in ('1', 'true', 'yes'):
+        return StreamingResponse(
+            (format_sse(event, data) for event, data in stream_chat(messages)),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"}
+        )
+
+    response_object = await asyncio.to_thread(complete_chat, messages)
+
+    return Response(
+        json.dumps(response_object),
+        status_code=200,
+        media_type="application/json"
+    )
 
-    response = chat_complete(messages, functions= functions, function_call= "auto")
+def complete_chat(messages):
+    """ Run a chat turn without streaming. Returns {"messages": ..., "products": ...}. """
 
     products = []
-    
-    try:
-        response_message = response["choices"][0]["message"]
-    except:
-        logging.info(response)
+    turn_start = len(messages)
+    cache_context, question_vector, cached_turn = lookup_answer_cache(messages)
 
-    # if the model wants to call a function
-    if response_message.get("function_call"):
-        # Call the function. The JSON response may not always be valid so make sure to handle errors
-        function_name = response_message["function_call"]["name"]
-
-        available_functions = {
-                "get_bonus_points": get_bonus_points,
-                "get_order_details": get_order_details,
-                "order_product": order_product,
-                "get_product_information": get_product_information,
-        }
-        function_to_call = available_functions[function_name] 
-
-        function_args = json.loads(response_message["function_call"]["arguments"])
-        function_response = function_to_call(**function_args)
-        # print(function_name, function_args)
-
-        # Add the assistant response and function response to the messages
-        messages.append({
-            "role": response_message["role"],
-            "function_call": {
-                "name": function_name,
-                "arguments": response_message["function_call"]["arguments"],
-            },
-            "content": None
-        })
-
-        if function_to_call == get_product_information:
-            product_info = json.loads(function_response)
-            # show product information after search for a different product that the current one
-            # if product_info['product_image_file'] != current_product_image:
-                
-            products = [display_product_info(product_info)]
-            current_product_image = product_info['product_image_file']
-            
-            # return only product description to LLM to avoid chatting about prices and image files 
-            function_response = product_info['description']
+    if cached_turn is not None:
+        products = replay_cached_turn(messages, cached_turn)
 
-        messages.append({
-            "role": "function",
-            "name": function_name,
-            "content": function_response,
-        })
+    else:
+        response = chat_complete(messages, functions= functions, function_call= "auto")
+
+        try:
+            response_message = response["choices"][0]["message"]
+        except:
+            logging.info(response)
+
+        # if the model wants to call a function
+        if response_message.get("function_call"):
+            products = call_function(response_message, messages)
      
-        response = chat_complete(messages, functions= functions, function_call= "none")
+            response = chat_complete(messages, functions= functions, function_call= "none")
         
-        response_message = response["choices"][0]["message"]
+            response_message = response["choices"][0]["message"]
 
-    messages.append({'role' : response_message['role'], 'content' : response_message['content']})
+        messages.append({'role' : response_message['role'], 'content' : response_message['content']})
 
-    logging.info(json.dumps(response_message))
+        logging.info(json.dumps(response_message))
 
-    response_object = {
+        store_answer_cache(cache_context, question_vector, messages, turn_start, products)
+
+    return {
         "messages": messages,
         "products": products
     }
 
-    return func.HttpResponse(
-        json.dumps(response_object),
-        status_code=200
-    )
+def call_function(response_message, messages):
+    """ Call the function requested by the model, add the call and its result to the messages. Returns the products to display. """
 
-def execute_sql_query(query, connection_string=database_connection_string, params=None):
-    """Execute a SQL query and return the results."""
+    products = []
+
+    # Call the function. The JSON response may not always be valid so make sure to handle errors
+    function_name = response_message["function_call"]["name"]
+
+    available_functions = {
+            "get_bonus_points": get_bonus_points,
+            "get_order_details": get_order_details,
+            "order_product": order_product,
+            "get_product_information": get_product_information,
+    }
+    function_to_call = available_functions[function_name] 
+
+    function_args = json.loads(response_message["function_call"]["arguments"])
+    function_response = function_to_call(**function_args)
+    # print(function_name, function_args)
+
+    # Add the assistant response and function response to the messages
+    messages.append({
+        "role": response_message["role"],
+        "function_call": {
+            "name": function_name,
+            "arguments": response_message["function_call"]["arguments"],
+        },
+        "content": None
+    })
+
+    if function_to_call == get_product_information:
+        product_info = json.loads(function_response)
+        # show product information after search for a different product that the current one
+        # if product_info['product_image_file'] != current_product_image:
+            
+        products = [display_product_info(product_info)]
+        
+        # return only product description to LLM to avoid chatting about prices and image files 
+        function_response = product_info['description']
+
+    messages.append({
+        "role": "function",
+        "name": function_name,
+        "content": function_response,
+    })
+
+    return products
+
+def stream_chat(messages):
+    """ Generate (event, data) pairs for a chat turn while the completions are streamed:
+
+        token     - each content delta of the assistant answer
+        sentence  - each complete sentence of the answer, so that TTS can start on the first one
+        products  - products to display, after a get_product_information call
+        done      - {"messages": ..., "products": ...}, the same object as the non-streaming response
+    """
+
+    products = []
+    turn_start = len(messages)
+    cache_context, question_vector, cached_turn = lookup_answer_cache(messages)
+
+    if cached_turn is not None:
+        products = replay_cached_turn(messages, cached_turn)
+        if products:
+            yield "products", products
+
+        answer = messages[-1]['content'] or ""
+        yield "token", answer
+        for sentence in split_sentences(answer):
+            yield "sentence", sentence
+
+        yield "done", {"messages": messages, "products": products}
+        return
+
+    response_message = yield from stream_completion(messages, function_call="auto")
+
+    # if the model wants to call a function, the answer comes from a second completion
+    if response_message.get("function_call"):
+        products = call_function(response_message, messages)
+        if products:
+            yield "products", products
+
+        response_message = yield from stream_completion(messages, function_call="none")
+
+    messages.append({'role' : response_message['role'], 'content' : response_message['content']})
+
+    logging.info(json.dumps(response_message))
+
+    store_answer_cache(cache_context, question_vector, messages, turn_start, products)
+
+    yield "done", {"messages": messages, "products": products}
+
+def split_sentences(text):
+    """ Sentences of a complete answer, split like the streamed sentence events """
+    sentences, start = [], 0
+    for match in sentence_end_regex.finditer(text):
+        sentences.append(text[start:match.end()].strip())
+        start = match.end()
+    sentences.append(text[start:].strip())
+    return [sentence for sentence in sentences if sentence]
+
+def get_cache_context(messages):
+    """ Answer cache partition of a chat turn: digest of the system prompt and of the tool results the answer may depend on.
+        None when the turn can't be cached: the last message is not a user question, or the conversation used account data.
+    """
+    if not messages or messages[-1].get('role') != 'user' or not isinstance(messages[-1].get('content'), str):
+        return None
+
+    for message in messages:
+        if message.get('name') in account_functions or (message.get('function_call') or {}).get('name') in account_functions:
+            return None
+
+    context = [message for message in messages[:-1] if message.get('role') in ('system', 'function')]
+    return hashlib.sha256(json.dumps(context, sort_keys=True).encode()).hexdigest()
+
+def lookup_answer_cache(messages):
+    """ (cache context, question embedding, cached turn) of the last user question. The cached turn is None on a miss. """
+    if not answer_cache_enabled:
+        return None, None, None
+
+    context = get_cache_context(messages)
+    if context is None:
+        return None, None, None
+
+    try:
+        cached_turn, vector = answer_cache.lookup(context, messages[-1]['content'], generate_embeddings)
+    except Exception as e:
+        logging.warning(f"Answer cache lookup failed: {e}")
+        return None, None, None
+
+    if cached_turn is not None:
+        logging.info("Answer cache hit")
+    return context, vector, cached_turn
+
+def replay_cached_turn(messages, cached_turn):
+    """ Add the messages of a cached turn (function call, function result and answer) to the conversation. Returns its products. """
+    messages.extend(cached_turn['messages'])
+    return cached_turn['products']
+
+def store_answer_cache(context, vector, messages, turn_start, products):
+    """ Cache the messages added to the conversation since turn_start, unless the turn called an account function """
+    if context is None:
+        return
+
+    turn = messages[turn_start:]
+    if any((message.get('function_call') or {}).get('name') in account_functions for message in turn):
+        return
+    if not turn or not turn[-1].get('content'):
+        return
+
+    try:
+        answer_cache.store(context, messages[turn_start - 1]['content'], vector, {"messages": turn, "products": products}, embed=generate_embeddings)
+    except Exception as e:
+        logging.warning(f"Answer cache store failed: {e}")
+
+def stream_completion(messages, function_call='auto'):
+    """ Stream one completion, yielding token and sentence events. Returns the assembled response message. """
+
+    content = ""
+    sentence_start = 0
+    name, arguments = "", ""
+
+    for delta in chat_complete_stream(messages, functions=functions, function_call=function_call):
+        if delta.get("function_call"):
+            name += delta["function_call"].get("name") or ""
+            arguments += delta["function_call"].get("arguments") or ""
+
+        if delta.get("content"):
+            content += delta["content"]
+            yield "token", delta["content"]
+
+            for match in sentence_end_regex.finditer(content, sentence_start):
+                sentence = content[sentence_start:match.end()].strip()
+                sentence_start = match.end()
+                if sentence:
+                    yield "sentence", sentence
+
+    if content[sentence_start:].strip():
+        yield "sentence", content[sentence_start:].strip()
+
+    if name:
+        return {"role": "assistant", "content": None, "function_call": {"name": name, "arguments": arguments}}
+    return {"role": "assistant", "content": content}
+
+def format_sse(event, data):
+    """ Server-sent event with JSON data """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def get_sql_pool(connection_string=database_connection_string):
+    """ Connection pool of a database, created on first use """
+    # the worker runs requests on several threads, only one of them may create the pool
+    with sql_pools_lock:
+        if connection_string not in sql_pools:
+            sql_pools[connection_string] = ConnectionPool(connection_string, max_size=sql_pool_max_size, max_idle_seconds=sql_pool_max_idle_seconds)
+        return sql_pools[connection_string]
+
+def run_sql_query(cursor, query, params=None):
+    """ Execute a SQL query on a cursor and return the results of a SELECT statement """
     results = []
-    print('database_connection_string', database_connection_string)
+
+    if params:
+        cursor.execute(query, params)
+    else:
+        cursor.execute(query)
     
-    # Establish the connection
-    with pyodbc.connect(connection_string) as conn:
-        cursor = conn.cursor()
-        
-        if params:
-            cursor.execute(query, params)
-        else:
-            cursor.execute(query)
-        
-        # If the query is a SELECT statement, fetch results
-        if query.strip().upper().startswith('SELECT'):
-            results = cursor.fetchall()
-        
-        conn.commit()
+    # If the query is a SELECT statement, fetch results
+    if query.strip().upper().startswith('SELECT'):
+        results = cursor.fetchall()
 
     return results
 
+def execute_sql_query(query, connection_string=database_connection_string, params=None):
+    """Execute a SQL query in its own transaction, on a pooled connection, and return the results."""
+    
+    with get_sql_pool(connection_string).transaction() as cursor:
+        return run_sql_query(cursor, query, params)
+
 def get_bonus_points(account_id):
     """Retrieve bonus points and its cash value for a given account ID."""
      
@@ -252,43 +474,77 @@ def get_order_details(account_id):
     # Return the JSON object
     return json.dumps(order_details)
 
+def ensure_order_sequence():
+    """ Create the dbo.OrderIds sequence, starting after the existing orders, on databases built before
+        create-index-and-database.ipynb created it. Needs the CREATE SEQUENCE permission only in that case.
+    """
+    global order_sequence_ready
+
+    if order_sequence_ready:
+        return
+
+    query = """
+        IF OBJECT_ID('dbo.OrderIds', 'SO') IS NULL
+        BEGIN
+            DECLARE @start INT = (SELECT ISNULL(MAX(order_id), 0) + 1 FROM Orders);
+            DECLARE @sql NVARCHAR(200) = N'CREATE SEQUENCE dbo.OrderIds AS INT START WITH ' + CAST(@start AS NVARCHAR(20));
+            EXEC sp_executesql @sql;
+        END
+    """
+    try:
+        execute_sql_query(query)
+    except pyodbc.Error as e:
+        # 42S01 / 2714: another instance created it between the check and the CREATE
+        sqlstate = e.args[0] if e.args else None
+        if sqlstate != '42S01' and '(2714)' not in str(e):
+            logging.error(f"Could not create the dbo.OrderIds sequence, create it with create-index-and-database.ipynb: {e}")
+            raise
+        logging.info(f"OrderIds sequence: {e}")
+
+    order_sequence_ready = True
+
 def order_product(account_id, product_name, quantity=1):
      
-    # Step 1: Find the maximum existing order_id
-    query = "SELECT MAX(order_id) FROM Orders"
-    results = execute_sql_query(query)
-    max_order_id = results[0][0] if results[0][0] is not None else 0
-
-    # Step 2 & 3: Find product ID and check stock
-    query = "SELECT id, name, stock FROM Products WHERE LOWER(name) LIKE LOWER(?)"
-    params = (f'%{product_name}%',)
-    results = execute_sql_query(query, params=params)
-    
-    # Handling no match found
-    if not results:
-        return json.dumps({"info": "No matching product found"})
-    
-    product_id, product_name_corrected, stock = results[0]
-    
-    # Check if the stock is sufficient
-    if stock < quantity:
-        return json.dumps({"info": "Insufficient stock"})
-    
-    # Step 4: Place the order
-    # Deducting the ordered quantity from the stock
-    query = "UPDATE Products SET stock = stock - ? WHERE id = ?"
-    params = (quantity, product_id)
-    if place_orders: execute_sql_query(query, params=params)
-
-    # Adding the order details to the Orders table
     days_to_delivery = 5
-    for i in range(quantity):
-        max_order_id += 1
-        query = "INSERT INTO Orders (order_id, product_id, days_to_delivery, account_id) VALUES (?, ?, ?, ?)"
-        params = (max_order_id, product_id, days_to_delivery, account_id)
-        if place_orders: execute_sql_query(query, params=params)
+    quantity = int(quantity)
+
+    if quantity < 1:
+        return json.dumps({"info": "Quantity must be at least 1"})
+
+    if place_orders: ensure_order_sequence()
+
+    # All the reads and writes of the order on one connection, in one transaction
+    with get_sql_pool().transaction() as cursor:
+
+        # Step 1: Find product ID
+        query = "SELECT id, name, stock FROM Products WHERE LOWER(name) LIKE LOWER(?)"
+        params = (f'%{product_name}%',)
+        results = run_sql_query(cursor, query, params=params)
+        
+        # Handling no match found
+        if not results:
+            return json.dumps({"info": "No matching product found"})
+        
+        product_id, product_name_corrected, stock = results[0]
+
+        if not place_orders:
+            # Check if the stock is sufficient, without reserving it
+            if stock < quantity:
+                return json.dumps({"info": "Insufficient stock"})
+
+        else:
+            # Step 2: Reserve the stock, the conditional update only succeeds if the stock is still sufficient
+            query = "UPDATE Products SET stock = stock - ? WHERE id = ? AND stock >= ?"
+            cursor.execute(query, (quantity, product_id, quantity))
+            if cursor.rowcount != 1:
+                return json.dumps({"info": "Insufficient stock"})
+
+            # Step 3: Add all the order rows in one batch, the order IDs come from the OrderIds sequence
+            query = "INSERT INTO Orders (order_id, product_id, days_to_delivery, account_id) VALUES (NEXT VALUE FOR dbo.OrderIds, ?, ?, ?)"
+            cursor.fast_executemany = True
+            cursor.executemany(query, [(product_id, days_to_delivery, account_id)] * quantity)
     
-    # Step 5: Calculate the expected delivery date and return the JSON object
+    # Step 4: Calculate the expected delivery date and return the JSON object
     today = datetime.now()
     expected_delivery_date = today + timedelta(days=days_to_delivery)
     
@@ -346,17 +602,33 @@ def generate_embeddings(text):
     response = requests.post(url, headers=headers, data=json.dumps(data)).json()
     return response['data'][0]['embedding']
 
+def get_product_index():
+    """ Product catalog index of the local product search, loaded at import when LOCAL_PRODUCT_SEARCH is on """
+    global product_index
+
+    if product_index is None:
+        product_index = ProductIndex.from_file(product_catalog_file, vector_field="description_vector")
+    return product_index
+
+def search_products(vector, categories='*', top_k=1):
+    """ Vector search of the products on description_vector, in the in-memory catalog index. Optional filter on categories field. """
+    return get_product_index().search(vector, k=top_k, category=None if categories == '*' else categories)
+
 def get_product_information(user_question, categories='*', top_k=1):
     """ Vectorize user query to search Cognitive Search vector search on index_name. Optional filter on categories field. """
-     
+
+    vector = generate_embeddings(user_question)
+
+    if local_product_search:
+        product_data = search_products(vector, categories, top_k)[0]
+        return format_product_information(product_data)
+
     url = f"{search_endpoint}/indexes/{search_index_name}/docs/search?api-version={search_api_version}"
 
     headers = {
         "Content-Type": "application/json",
         "api-key": f"{search_key}",
     }
-    
-    vector = generate_embeddings(user_question)
 
     data = {
         "vectors": [
@@ -379,6 +651,10 @@ def get_product_information(user_question, categories='*', top_k=1):
     # Extracting the required fields from the results JSON
     product_data = results_json['value'][0] # hard limit to top result for now
 
+    return format_product_information(product_data)
+
+def format_product_information(product_data):
+    """ Product fields returned to the chat, from a search result """
     response_data = {
         "tagline": product_data.get('tagline'),
         "description": product_data.get('description'),
@@ -408,3 +684,37 @@ def chat_complete(messages, functions, function_call='auto'):
     response = requests.post(url, headers=headers, data=json.dumps(data)).json()
 
     return response
+
+def chat_complete_stream(messages, functions, function_call='auto'):
+    """ Same as chat_complete with stream enabled. Generates the message deltas as they arrive. """
+
+    url = f"{AOAI_endpoint}/openai/deployments/{chat_deployment}/chat/completions?api-version={AOAI_api_version}"
+
+    headers = {
+        "Content-Type": "application/json",
+        "api-key": AOAI_key
+    }
+
+    data = {
+        "messages": messages,
+        "functions": functions,
+        "function_call": function_call,
+        "temperature" : 0,
+        "stream": True,
+    }
+
+    with requests.post(url, headers=headers, data=json.dumps(data), stream=True) as response:
+        response.raise_for_status()
+
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+
+            line = line[len("data:"):].strip()
+            if line == "[DONE]":
+                break
+
+            chunk = json.loads(line)
+            # the first chunks of Azure OpenAI may only carry content filter results
+            if chunk.get("choices"):
+                yield chunk["choices"][0].get("delta", {})
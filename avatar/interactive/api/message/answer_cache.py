@@ -0,0 +1,118 @@
+import copy
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class AnswerCache:
+    """ Semantic cache of chat turns, keyed by the embedding of the user question.
+
+        Entries are partitioned by a context key (for the chat, the system prompt and the tool results the
+        conversation already holds), a lookup only matches entries of the same context whose question embedding
+        has a cosine similarity of at least threshold with the new question. A question repeated word for word
+        is matched on its text, without computing its embedding.
+        Entries expire ttl_seconds after they were stored, the least recently used entry is evicted beyond max_entries.
+    """
+
+    def __init__(self, threshold=0.95, ttl_seconds=3600, max_entries=1000):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        self.entries = OrderedDict()    # slot -> entry dict, least recently used first
+        self.texts = {}                 # (context, normalized question) -> slot
+        self.vectors = None             # max_entries x dim matrix of normalized question embeddings, one row per slot
+        self.contexts = np.empty(max_entries, dtype=object)
+        self.free_slots = list(range(max_entries - 1, -1, -1))
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize_text(text):
+        return " ".join(text.lower().split())
+
+    @staticmethod
+    def normalize_vector(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def is_expired(self, entry, now):
+        return now - entry['created'] > self.ttl_seconds
+
+    def remove(self, slot):
+        """ Free the slot of an entry. Called with the lock held. """
+        entry = self.entries.pop(slot)
+        self.texts.pop((entry['context'], entry['text']), None)
+        self.contexts[slot] = None
+        self.free_slots.append(slot)
+
+    def hit(self, slot):
+        """ Copy of the value of a live entry, marked as most recently used. Called with the lock held. """
+        self.entries.move_to_end(slot)
+        return copy.deepcopy(self.entries[slot]['value'])
+
+    def lookup(self, context, question, embed):
+        """ Returns (cached value or None, question embedding or None).
+
+            embed(question) is only called when the question text is not cached as it is, the embedding is
+            returned so that it can be passed to store after a miss.
+        """
+        text = self.normalize_text(question)
+        now = time.monotonic()
+
+        with self.lock:
+            slot = self.texts.get((context, text))
+            if slot is not None:
+                if not self.is_expired(self.entries[slot], now):
+                    return self.hit(slot), None
+                self.remove(slot)
+
+        vector = self.normalize_vector(embed(question))
+
+        with self.lock:
+            if self.vectors is None or not self.entries:
+                return None, vector
+
+            scores = self.vectors @ vector
+            scores[self.contexts != context] = -1
+
+            for slot in np.argsort(-scores):
+                if scores[slot] < self.threshold:
+                    break
+                if self.is_expired(self.entries[slot], now):
+                    self.remove(slot)
+                    continue
+                return self.hit(slot), vector
+
+        return None, vector
+
+    def store(self, context, question, vector, value, embed=None):
+        """ Cache value for a question. vector is the question embedding, computed with embed(question) when None. """
+        text = self.normalize_text(question)
+        if vector is None:
+            vector = embed(question)
+        vector = self.normalize_vector(vector)
+
+        with self.lock:
+            slot = self.texts.get((context, text))
+            if slot is not None:
+                self.remove(slot)
+
+            if not self.free_slots:
+                self.remove(next(iter(self.entries)))
+
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+
+            slot = self.free_slots.pop()
+            self.vectors[slot] = vector
+            self.contexts[slot] = context
+            self.texts[(context, text)] = slot
+            self.entries[slot] = {'context': context, 'text': text, 'created': time.monotonic(), 'value': copy.deepcopy(value)}
+
+    def clear(self):
+        with self.lock:
+            for slot in list(self.entries):
+                self.remove(slot)
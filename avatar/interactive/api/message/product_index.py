@@ -0,0 +1,71 @@
+import json
+import logging
+
+import numpy as np
+
+
+class ProductIndex:
+    """ In-memory vector index of the product catalog (data/product-catalog-vectors.json).
+
+        The vectors of vector_field are stored as one normalized float32 matrix, plus one sub-matrix per category,
+        so that a search filtered on a category only scores the products of that category.
+        Scores are cosine similarities, like the cosine vector search of the search index.
+    """
+
+    def __init__(self, products, vector_field='description_vector'):
+        self.vector_field = vector_field
+        self.products = [{k: v for k, v in product.items() if not k.endswith('_vector')} for product in products]
+
+        matrix = np.array([product[vector_field] for product in products], dtype=np.float32).reshape(len(products), -1)
+        self.matrix = self.normalize(matrix)
+
+        self.categories = {}
+        for i, product in enumerate(self.products):
+            self.categories.setdefault(product.get('category'), []).append(i)
+
+        # category -> (row numbers in self.products, contiguous sub-matrix of those rows)
+        self.category_indexes = {}
+        for category, rows in self.categories.items():
+            rows = np.array(rows)
+            self.category_indexes[category] = (rows, np.ascontiguousarray(self.matrix[rows]))
+
+    @classmethod
+    def from_file(cls, filename, vector_field='description_vector'):
+        with open(filename, 'r') as f:
+            products = json.load(f)
+
+        index = cls(products, vector_field=vector_field)
+        logging.info(f"Loaded {len(index.products)} products in {len(index.categories)} categories from {filename}")
+        return index
+
+    @staticmethod
+    def normalize(matrix):
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+    def search(self, vector, k=1, category=None):
+        """ Top k products for a query vector, best first, each with its '@search.score'. Optional filter on category. """
+        if category is None:
+            rows, matrix = None, self.matrix
+        elif category in self.category_indexes:
+            rows, matrix = self.category_indexes[category]
+        else:
+            return []
+
+        query = self.normalize(np.asarray(vector, dtype=np.float32))
+        scores = matrix @ query
+
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        for i in top:
+            product = dict(self.products[i if rows is None else rows[i]])
+            product['@search.score'] = float(scores[i])
+            results.append(product)
+        return results
@@ -0,0 +1,120 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import pyodbc
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """ Pool of pyodbc connections to one database.
+
+        Connections are reused most-recently-used first, closed after max_idle_seconds without use, and checked
+        with a cheap query before reuse when they have been idle for more than health_check_seconds.
+        At most max_size connections are open at once, acquire waits up to timeout seconds for one to be released.
+    """
+
+    def __init__(self, connection_string, max_size=5, max_idle_seconds=300, health_check_seconds=30, timeout=30, connect=pyodbc.connect):
+        self.connection_string = connection_string
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.health_check_seconds = health_check_seconds
+        self.timeout = timeout
+        self.connect = connect
+
+        self.idle = []          # (connection, last used), most recently used last
+        self.size = 0           # open connections, idle or in use
+        self.condition = threading.Condition()
+
+    def evict_idle(self):
+        """ Close the connections unused for more than max_idle_seconds. Called with the condition held. """
+        now = time.monotonic()
+        expired = [conn for conn, last_used in self.idle if now - last_used > self.max_idle_seconds]
+        self.idle = [(conn, last_used) for conn, last_used in self.idle if now - last_used <= self.max_idle_seconds]
+
+        for conn in expired:
+            self.close_connection(conn)
+
+    def close_connection(self, conn):
+        self.size -= 1
+        try:
+            conn.close()
+        except pyodbc.Error:
+            pass
+
+    def is_healthy(self, conn):
+        try:
+            conn.cursor().execute("SELECT 1").fetchall()
+            return True
+        except pyodbc.Error as e:
+            logging.info(f"Discarding broken SQL connection: {e}")
+            return False
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+
+        with self.condition:
+            while True:
+                self.evict_idle()
+
+                if self.idle:
+                    conn, last_used = self.idle.pop()
+                    if (time.monotonic() - last_used <= self.health_check_seconds) or self.is_healthy(conn):
+                        return conn
+                    self.close_connection(conn)
+                    continue
+
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"No SQL connection available after {self.timeout}s (max_size={self.max_size})")
+                self.condition.wait(remaining)
+
+        # connect outside of the lock, it is a network round trip (and a TLS handshake for Azure SQL)
+        try:
+            return self.connect(self.connection_string)
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        with self.condition:
+            if discard:
+                self.close_connection(conn)
+            else:
+                self.idle.append((conn, time.monotonic()))
+            self.condition.notify()
+
+    @contextmanager
+    def transaction(self):
+        """ Unit of work: a cursor on a pooled connection, committed when the block succeeds, rolled back otherwise """
+        conn = self.acquire()
+        discard = False
+
+        try:
+            cursor = conn.cursor()
+            yield cursor
+            conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except pyodbc.Error:
+                discard = True
+            raise
+        finally:
+            self.release(conn, discard)
+
+    def close(self):
+        with self.condition:
+            for conn, _ in self.idle:
+                self.close_connection(conn)
+            self.idle = []
@@ -0,0 +1,109 @@
+"""
+Concurrency check of the avatar order_product function against the SQL database.
+
+Places --orders orders of --quantity units of one product from --workers threads at once, with place_orders on,
+then checks that the stock was never oversold and that every order row got its own order ID from dbo.OrderIds:
+
+    orders placed * quantity == new order rows == stock before - stock after, stock after >= 0, order IDs unique
+
+The settings are read from api/local.settings.json (or the environment) like the function app.
+This WRITES orders to the database: run it against a test database, --cleanup deletes the new orders and
+gives the stock back afterwards.
+
+    python order_concurrency_check.py --product "Elysian Voyager" --orders 50 --quantity 2 --workers 16 --cleanup
+"""
+
+import os
+import sys
+import json
+import argparse
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api")
+
+
+
+def load_local_settings(filename = os.path.join(API_DIR, "local.settings.json")):
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            for key, value in json.load(f).get("Values", {}).items():
+                os.environ.setdefault(key, value)
+
+
+def get_product(message, cursor, product_name):
+    query = "SELECT id, name, stock FROM Products WHERE LOWER(name) LIKE LOWER(?)"
+    results = message.run_sql_query(cursor, query, params=(f'%{product_name}%',))
+    if not results:
+        raise Exception(f"No product matching {product_name}")
+    return results[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Place concurrent orders with order_product and check stock and order IDs")
+    parser.add_argument('--product', default="Elysian Voyager", help="Product name, matched like order_product does")
+    parser.add_argument('--orders', type=int, default=50)
+    parser.add_argument('--quantity', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--account_id', type=int, default=1000)
+    parser.add_argument('--cleanup', action='store_true', help="Delete the new orders and restore the stock at the end")
+    args = parser.parse_args()
+
+    load_local_settings()
+    sys.path.insert(0, API_DIR)
+    import message
+
+    message.place_orders = True
+    # one connection per worker, so that the orders really run concurrently
+    pool = message.ConnectionPool(message.database_connection_string, max_size=args.workers)
+    message.sql_pools[message.database_connection_string] = pool
+
+    message.ensure_order_sequence()
+
+    with pool.transaction() as cursor:
+        product_id, product_name, stock_before = get_product(message, cursor, args.product)
+        max_order_before = message.run_sql_query(cursor, "SELECT ISNULL(MAX(order_id), 0) FROM Orders")[0][0]
+
+    print(f"{product_name}: stock {stock_before}, placing {args.orders} orders of {args.quantity} from {args.workers} threads")
+
+    def place(i):
+        return json.loads(message.order_product(args.account_id, product_name, args.quantity))['info']
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        infos = collections.Counter(executor.map(place, range(args.orders)))
+
+    with pool.transaction() as cursor:
+        _, _, stock_after = get_product(message, cursor, product_name)
+        rows = message.run_sql_query(cursor, "SELECT order_id FROM Orders WHERE order_id > ? AND product_id = ?",
+                                     params=(max_order_before, product_id))
+
+    order_ids = [row[0] for row in rows]
+    placed = infos.get("Order placed", 0)
+
+    checks = {
+        'order rows match placed orders': len(order_ids) == placed * args.quantity,
+        'stock decreased by the ordered units': stock_before - stock_after == placed * args.quantity,
+        'stock not negative': stock_after >= 0,
+        'order IDs unique': len(set(order_ids)) == len(order_ids),
+    }
+
+    print(f"Results: {dict(infos)}")
+    print(f"Stock {stock_before} -> {stock_after}, {len(order_ids)} new order rows")
+    for check, ok in checks.items():
+        print(f"    {'OK  ' if ok else 'FAIL'} {check}")
+
+    if args.cleanup:
+        with pool.transaction() as cursor:
+            cursor.execute("DELETE FROM Orders WHERE order_id > ? AND product_id = ?", (max_order_before, product_id))
+            cursor.execute("UPDATE Products SET stock = stock + ? WHERE id = ?", (stock_before - stock_after, product_id))
+        print("Cleaned up the new orders and restored the stock")
+
+    pool.close()
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -142,27 +142,68 @@ function setupWebRTC() {
     })
 }
 
-async function generateText(prompt) {
+// Send the conversation to /api/message in streaming mode. The reply comes as server-sent events:
+// token (answer delta), sentence (complete sentence of the answer), products, done ({messages, products}).
+// onSentence is called on each sentence, so that the avatar starts speaking before the answer is complete.
+async function generateText(prompt, onSentence) {
 
   messages.push({
     role: 'user',
     content: prompt
   });
 
-  let generatedText
-  let products
-  await fetch(`/api/message`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(messages) })
-    .then(response => response.json())
-    .then(data => {
-      generatedText = data["messages"][data["messages"].length - 1].content;
+  let generatedText = ""
+  let products = []
+
+  const response = await fetch(`/api/message?stream=1`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(messages) })
+  if (!response.ok) {
+    throw new Error(`/api/message failed with status ${response.status}`)
+  }
+  const reader = response.body.getReader()
+  const decoder = new TextDecoder()
+  let buffer = ""
+
+  const handleEvent = (event, data) => {
+    if (event === 'sentence') {
+      onSentence(data)
+    } else if (event === 'products') {
+      products = data
+      if (products.length > 0) {
+        addProductToChatHistory(products[0]);
+      }
+    } else if (event === 'done') {
       messages = data["messages"];
-      products = data["products"]
-    });
+      generatedText = messages[messages.length - 1].content;
+    }
+  }
 
-  addToConversationHistory(generatedText, 'light');
-  if (products.length > 0) {
-    addProductToChatHistory(products[0]);
+  while (true) {
+    const { value, done } = await reader.read()
+    if (done) {
+      break
+    }
+    buffer += decoder.decode(value, { stream: true })
+
+    // events are separated by a blank line
+    let end
+    while ((end = buffer.indexOf('\n\n')) >= 0) {
+      let event = 'message'
+      let data = ''
+      for (const line of buffer.slice(0, end).split('\n')) {
+        if (line.startsWith('event:')) {
+          event = line.slice('event:'.length).trim()
+        } else if (line.startsWith('data:')) {
+          data += line.slice('data:'.length).trim()
+        }
+      }
+      buffer = buffer.slice(end + 2)
+      if (data) {
+        handleEvent(event, JSON.parse(data))
+      }
+    }
   }
+
+  addToConversationHistory(generatedText, 'light');
   return generatedText;
 }
 
@@ -364,28 +405,29 @@ window.speak = (text) => {
       .then(async language => {
         console.log(`Detected language: ${language}`);
 
-        const generatedResult = await generateText(text);
-
-        let spokenTextssml = `<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xmlns:mstts='https://www.w3.org/2001/mstts' xml:lang='en-US'><voice xml:lang='en-US' xml:gender='Female' name='zh-CN-XiaochenMultilingualNeural'><lang xml:lang="${language}">${generatedResult}</lang></voice></speak>`
+        // speak each sentence as soon as it is generated, the avatar synthesizer queues the requests in order
+        await generateText(text, (sentence) => {
+          let spokenTextssml = `<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xmlns:mstts='https://www.w3.org/2001/mstts' xml:lang='en-US'><voice xml:lang='en-US' xml:gender='Female' name='zh-CN-XiaochenMultilingualNeural'><lang xml:lang="${language}">${sentence}</lang></voice></speak>`
 
-        if (language == 'ar-AE') {
-          spokenTextssml = `<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xmlns:mstts='https://www.w3.org/2001/mstts' xml:lang='en-US'><voice xml:lang='en-US' xml:gender='Female' name='ar-AE-FatimaNeural'><lang xml:lang="${language}">${generatedResult}</lang></voice></speak>`
-        }
-        let spokenText = generatedResult
-        avatarSynthesizer.speakSsmlAsync(spokenTextssml, (result) => {
-          if (result.reason === SpeechSDK.ResultReason.SynthesizingAudioCompleted) {
-            console.log("Speech synthesized to speaker for text [ " + spokenText + " ]. Result ID: " + result.resultId)
-          } else {
-            console.log("Unable to speak text. Result ID: " + result.resultId)
-            if (result.reason === SpeechSDK.ResultReason.Canceled) {
-              let cancellationDetails = SpeechSDK.CancellationDetails.fromResult(result)
-              console.log(cancellationDetails.reason)
-              if (cancellationDetails.reason === SpeechSDK.CancellationReason.Error) {
-                console.log(cancellationDetails.errorDetails)
+          if (language == 'ar-AE') {
+            spokenTextssml = `<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xmlns:mstts='https://www.w3.org/2001/mstts' xml:lang='en-US'><voice xml:lang='en-US' xml:gender='Female' name='ar-AE-FatimaNeural'><lang xml:lang="${language}">${sentence}</lang></voice></speak>`
+          }
+          let spokenText = sentence
+          avatarSynthesizer.speakSsmlAsync(spokenTextssml, (result) => {
+            if (result.reason === SpeechSDK.ResultReason.SynthesizingAudioCompleted) {
+              console.log("Speech synthesized to speaker for text [ " + spokenText + " ]. Result ID: " + result.resultId)
+            } else {
+              console.log("Unable to speak text. Result ID: " + result.resultId)
+              if (result.reason === SpeechSDK.ResultReason.Canceled) {
+                let cancellationDetails = SpeechSDK.CancellationDetails.fromResult(result)
+                console.log(cancellationDetails.reason)
+                if (cancellationDetails.reason === SpeechSDK.CancellationReason.Error) {
+                  console.log(cancellationDetails.errorDetails)
+                }
               }
             }
-          }
-        })
+          })
+        });
       })
       .catch(error => {
         console.error('Error:', error);
@@ -16,14 +16,26 @@ import json
 import math
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
+import numpy as np
 import os
 import pandas as pd
 import requests
 import seaborn as sns
+import sys
+import threading
+import time
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dotenv import load_dotenv
 from io import BytesIO
 from PIL import Image
+from requests.adapters import HTTPAdapter
+
+# Shared embedding cache lives at the root of the repository
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from embedding_cache import get_embedding_cache, image_key, text_key
+from embedding_store import EmbeddingStore
+from image_preprocessing import read_image_file
 
 
 # Reading Azure Computer Vision 4 endpoint and key from the env file
@@ -35,9 +47,10 @@ endpoint = os.getenv("azure_cv_endpoint")
 
 # Python functions
 
-def image_embedding(image_file):
+def image_embedding(image_file, shrink=None):
     """
     Embedding image using Azure Computer Vision 4 Florence
+    With shrink, the image is downsized before the upload
     """
     version = "?api-version=2023-02-01-preview&modelVersion=latest"
     vec_img_url = endpoint + "/computervision/retrieval:vectorizeImage" + version
@@ -47,10 +60,13 @@ def image_embedding(image_file):
         'Ocp-Apim-Subscription-Key': key
     }
 
-    with open(image_file, 'rb') as f:
-        data = f.read()
-    r = requests.post(vec_img_url, data=data, headers=headers_image)
-    image_emb = r.json()['vector']
+    data = read_image_file(image_file, shrink)
+
+    def vectorize():
+        r = requests.post(vec_img_url, data=data, headers=headers_image)
+        return r.json()['vector']
+
+    image_emb = get_embedding_cache().get_or_compute(image_key(data), vectorize)
 
     return image_emb
 
@@ -88,10 +104,14 @@ def text_embedding(promptxt):
     }
 
     prompt = {'text': promptxt}
-    r = requests.post(vec_txt_url,
-                      data=json.dumps(prompt),
-                      headers=headers_prompt)
-    text_emb = r.json()['vector']
+
+    def vectorize():
+        r = requests.post(vec_txt_url,
+                          data=json.dumps(prompt),
+                          headers=headers_prompt)
+        return r.json()['vector']
+
+    text_emb = get_embedding_cache().get_or_compute(text_key(promptxt), vectorize)
 
     return text_emb
 
@@ -123,54 +143,172 @@ def view_image(image_file):
     plt.show()
 
 
-def get_similar_images_using_image(list_emb, image_files, image_file):
+def normalize_embeddings(embeddings):
     """
-    Get similar images using an image with Azure Computer Vision 4 Florence
+    Convert embeddings to a float32 array with unit L2 norm along the last axis
+    Zero vectors are left as zeros so they score 0 instead of NaN
     """
-    ref_emb = image_embedding(image_file)
-    idx = 0
-    results_list = []
+    emb = np.array(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(emb, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    emb /= norms
 
-    for emb_image in list_emb:
-        simil = get_cosine_similarity(ref_emb, list_emb[idx])
-        results_list.append(simil)
-        idx += 1
+    return emb
 
-    df_files = pd.DataFrame(image_files, columns=['image_file'])
-    df_simil = pd.DataFrame(results_list, columns=['similarity'])
-    df = pd.concat([df_files, df_simil], axis=1)
-    df.sort_values('similarity',
-                   axis=0,
-                   ascending=False,
-                   inplace=True,
-                   na_position='last')
 
-    return df
+class SimilarityEngine:
+    """
+    Cosine similarity search over a set of image embeddings
+    All the embeddings are kept in one pre-normalized float32 matrix so scoring
+    a query is a single matrix-vector product
+    """
+
+    def __init__(self, list_emb, image_files):
+        if len(list_emb) != len(image_files):
+            raise ValueError(
+                f"Got {len(list_emb)} embeddings for {len(image_files)} image files")
+
+        self.list_emb = list_emb
+        self.image_files_src = image_files
+        self.image_files = list(image_files)
+        self.matrix = normalize_embeddings(list_emb)
+
+    def __len__(self):
+        return len(self.image_files)
+
+    def get_similarity(self, query_emb):
+        """
+        Cosine similarity between a query embedding and every image embedding
+        """
+        return self.matrix @ normalize_embeddings(query_emb)
+
+    def get_topn_indices(self, simil, topn=None):
+        """
+        Indices of the topn highest similarities, best first
+        Uses argpartition so only the topn rows are sorted
+        """
+        if topn is None or topn >= len(simil):
+            return np.argsort(-simil, kind='stable')
+
+        idx = np.argpartition(-simil, topn)[:topn]
+
+        return idx[np.argsort(-simil[idx], kind='stable')]
+
+    def to_dataframe(self, simil, idx):
+        """
+        Build the image_file / similarity dataframe for the selected rows
+        """
+        return pd.DataFrame(
+            {
+                'image_file': [self.image_files[i] for i in idx],
+                'similarity': simil[idx].astype(np.float64)
+            },
+            index=idx)
+
+    def search(self, query_emb, topn=None):
+        """
+        Get the topn most similar images to an embedding as a dataframe
+        sorted by descending similarity (all images if topn is None)
+        """
+        simil = self.get_similarity(query_emb)
+        idx = self.get_topn_indices(simil, topn)
+
+        return self.to_dataframe(simil, idx)
+
+    def search_batch(self, query_embs, topn=None):
+        """
+        Get the topn most similar images for several query embeddings at once
+        All the queries are scored with one matrix-matrix product
+        Returns one dataframe per query, in the order of the queries
+        """
+        simils = normalize_embeddings(query_embs) @ self.matrix.T
 
+        results = []
+        for simil in simils:
+            idx = self.get_topn_indices(simil, topn)
+            results.append(self.to_dataframe(simil, idx))
 
-def get_similar_images_using_prompt(prompt, image_files, list_emb):
+        return results
+
+
+_similarity_engine = None
+
+
+def get_similarity_engine(list_emb, image_files):
+    """
+    Get a SimilarityEngine for the embeddings
+    The last engine is reused as long as it was built from the same lists
+    """
+    global _similarity_engine
+
+    if isinstance(list_emb, SimilarityEngine):
+        return list_emb
+
+    engine = _similarity_engine
+    if (engine is None or engine.list_emb is not list_emb
+            or engine.image_files_src is not image_files
+            or len(engine) != len(list_emb)):
+        engine = SimilarityEngine(list_emb, image_files)
+        _similarity_engine = engine
+
+    return engine
+
+
+def get_similar_images_using_image(list_emb, image_files, image_file, topn=None):
+    """
+    Get similar images using an image with Azure Computer Vision 4 Florence
+    list_emb can be a list of embeddings or a SimilarityEngine
+    """
+    ref_emb = image_embedding(image_file)
+    engine = get_similarity_engine(list_emb, image_files)
+
+    return engine.search(ref_emb, topn)
+
+
+def get_similar_images_using_prompt(prompt, image_files, list_emb, topn=None):
     """
     Get similar umages using a prompt with Azure Computer Vision 4 Florence
+    list_emb can be a list of embeddings or a SimilarityEngine
     """
     prompt_emb = text_embedding(prompt)
-    idx = 0
-    results_list = []
+    engine = get_similarity_engine(list_emb, image_files)
 
-    for emb_image in list_emb:
-        simil = get_cosine_similarity(prompt_emb, list_emb[idx])
-        results_list.append(simil)
-        idx += 1
+    return engine.search(prompt_emb, topn)
 
-    df_files = pd.DataFrame(image_files, columns=['image_file'])
-    df_simil = pd.DataFrame(results_list, columns=['similarity'])
-    df = pd.concat([df_files, df_simil], axis=1)
-    df.sort_values('similarity',
-                   axis=0,
-                   ascending=False,
-                   inplace=True,
-                   na_position='last')
 
-    return df
+def get_embeddings_concurrently(embedding_function, items, max_workers=8):
+    """
+    Embed a list of images or prompts with a pool of threads
+    The embeddings are returned in the order of the items
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(embedding_function, items))
+
+
+def get_similar_images_using_images(list_emb, image_files, ref_image_files,
+                                    topn=5, max_workers=8):
+    """
+    Get similar images for a list of reference images with Azure Computer Vision 4 Florence
+    Returns one dataframe per reference image
+    """
+    ref_embs = get_embeddings_concurrently(image_embedding, ref_image_files,
+                                           max_workers=max_workers)
+    engine = get_similarity_engine(list_emb, image_files)
+
+    return engine.search_batch(ref_embs, topn)
+
+
+def get_similar_images_using_prompts(prompts, image_files, list_emb,
+                                     topn=5, max_workers=8):
+    """
+    Get similar images for a list of prompts with Azure Computer Vision 4 Florence
+    Returns one dataframe per prompt
+    """
+    prompt_embs = get_embeddings_concurrently(text_embedding, prompts,
+                                              max_workers=max_workers)
+    engine = get_similarity_engine(list_emb, image_files)
+
+    return engine.search_batch(prompt_embs, topn)
 
 
 def get_topn_images(df, topn=5, disp=False):
@@ -279,12 +417,165 @@ def get_img_embedding_multiprocessing(image_file):
         'Ocp-Apim-Subscription-Key': key
     }
 
-    emb = requests.post(vec_img_url,
-                        data=open(image_file, 'rb').read(),
+    with open(image_file, 'rb') as f:
+        data = f.read()
+
+    emb = requests.post(vec_img_url, data=data,
                         headers=headers_images).json()['vector']
     return emb
 
 
+class RateLimiter:
+    """
+    Spread requests evenly to stay under a requests-per-second budget
+    Shared by all the threads of a bulk vectorization run
+    """
+
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until the next request slot
+        """
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+    def pause(self, seconds):
+        """
+        Hold back all the threads for some seconds (throttling / Retry-After)
+        """
+        with self.lock:
+            self.next_time = max(self.next_time, time.monotonic() + seconds)
+
+
+def get_retry_after(response, attempt):
+    """
+    Seconds to wait before retrying a throttled request
+    Uses the Retry-After header when present, else exponential backoff
+    """
+    retry_after = response.headers.get('Retry-After')
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return min(60.0, 2.0 ** attempt)
+
+
+def vectorize_image_file(session, image_file, limiter, max_retries=8):
+    """
+    Embed one image file through a pooled session, streaming the file
+    Throttled (429) and unavailable (503) responses are retried after the
+    Retry-After delay, which also pauses the other threads
+    """
+    version = "?api-version=2023-02-01-preview&modelVersion=latest"
+    vec_img_url = endpoint + "/computervision/retrieval:vectorizeImage" + version
+
+    headers_images = {
+        'Content-type': 'application/octet-stream',
+        'Ocp-Apim-Subscription-Key': key
+    }
+
+    for attempt in range(max_retries):
+        limiter.wait()
+        with open(image_file, 'rb') as f:
+            r = session.post(vec_img_url, data=f, headers=headers_images)
+
+        if r.status_code in (429, 503):
+            limiter.pause(get_retry_after(r, attempt))
+            continue
+
+        r.raise_for_status()
+        return r.json()['vector']
+
+    raise RuntimeError(f"Too many throttled requests for {image_file}")
+
+
+def list_image_files(image_dir, extensions=('.jpg', '.jpeg', '.png')):
+    """
+    Walk a directory and yield the image files
+    """
+    for root, _, files in os.walk(image_dir):
+        for file in sorted(files):
+            if file.lower().endswith(extensions):
+                yield os.path.join(root, file)
+
+
+def vectorize_image_folder(image_dir, store_dir, requests_per_second=10,
+                           max_workers=8, batch_size=64, max_retries=8,
+                           dim=1024, extensions=('.jpg', '.jpeg', '.png')):
+    """
+    Compute embeddings with Azure Computer Vision 4 Florence for all the images
+    of a directory and write them to an EmbeddingStore
+
+    Requests share one pooled session and are limited to requests_per_second
+    with at most max_workers in flight. Images already in the store are
+    skipped, so a crashed run resumes where it stopped.
+    """
+    store = EmbeddingStore.open(store_dir, dim=dim, mode='r+')
+    limiter = RateLimiter(requests_per_second)
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    nb_skipped = 0
+    nb_embedded = 0
+    failed = []
+    paths, embeddings = [], []
+
+    def save_batch():
+        nonlocal nb_embedded
+        if paths:
+            store.append(paths, embeddings)
+            nb_embedded += len(paths)
+            paths.clear()
+            embeddings.clear()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+
+        def collect(done):
+            for future in done:
+                image_file = in_flight.pop(future)
+                try:
+                    embeddings.append(future.result())
+                    paths.append(image_file)
+                except Exception as e:
+                    print(f"Error with {image_file}: {e}")
+                    failed.append(image_file)
+            if len(paths) >= batch_size:
+                save_batch()
+
+        for image_file in list_image_files(image_dir, extensions):
+            if image_file in store:
+                nb_skipped += 1
+                continue
+
+            if len(in_flight) >= 2 * max_workers:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            future = executor.submit(vectorize_image_file, session, image_file,
+                                     limiter, max_retries)
+            in_flight[future] = image_file
+
+        collect(wait(in_flight).done)
+        save_batch()
+
+    session.close()
+
+    print(f"Embedded {nb_embedded} images, skipped {nb_skipped} already in {store_dir}, "
+          f"{len(failed)} failed")
+
+    return {'embedded': nb_embedded, 'skipped': nb_skipped, 'failed': failed}
+
+
 def remove_background(image_file):
     """
     Removing background from an image file using Azure Computer Vision 4
@@ -381,7 +672,8 @@ def get_results_using_image(reference_image, nobackground_image,
     Get the topn results from a visual search using an image
     Will generate a df, display the topn images and return the df
     """
-    df = get_similar_images_using_image(list_emb, image_files, nobackground_image)
+    df = get_similar_images_using_image(list_emb, image_files,
+                                        nobackground_image, topn)
     df.head(topn).style.background_gradient(
         cmap=sns.light_palette("green", as_cmap=True))
   
@@ -399,7 +691,7 @@ def get_results_using_prompt(query, image_files, list_emb, topn, disp=False):
     Get the topn results from a visual search using a text query
     Will generate a df, display the topn images and return the df
     """
-    df = get_similar_images_using_prompt(query, image_files, list_emb)
+    df = get_similar_images_using_prompt(query, image_files, list_emb, topn)
     df.head(topn).style.background_gradient(
         cmap=sns.light_palette("green", as_cmap=True))
   
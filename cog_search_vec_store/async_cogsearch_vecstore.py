@@ -0,0 +1,357 @@
+import asyncio
+import copy
+import re
+import time
+
+from cog_search_vec_store import async_http_helpers
+from cog_search_vec_store import async_cv_helpers
+from cog_search_vec_store import cs_json
+from cog_search_vec_store.cogsearch_vecstore import CogSearchVecStore, QueryEmbeddingCache, NUM_TOP_MATCHES, IMAGE_URL_REGEX
+from cog_search_vec_store.cogsearch_vecstore import QUERY_CACHE_SIZE, QUERY_CACHE_TTL
+from cog_search_vec_store.cogsearch_vecstore import MAX_BATCH_DOCS, MAX_BATCH_BYTES, RETRYABLE_STATUS_CODES, SEARCH_PAGE_SIZE
+from cog_search_vec_store.cogsearch_vecstore import VECTOR_FIELDS
+from cog_search_vec_store.local_index import reciprocal_rank_fusion
+
+from utils import get_openai_embedding
+
+
+
+
+class AsyncCogSearchVecStore(CogSearchVecStore):
+    """
+    asyncio version of CogSearchVecStore. Requests go through a shared aiohttp connection pool,
+    so many searches can be in flight from a single worker.
+
+    Payload building and result processing are inherited from CogSearchVecStore.
+    """
+
+    def __init__(self, api_key,
+                       search_service_name,
+                       index_name = "img-vec-index",
+                       api_version = "2023-07-01-Preview",
+                       session = None,
+                       query_cache_size = QUERY_CACHE_SIZE,
+                       query_cache_ttl = QUERY_CACHE_TTL):
+
+
+        self.http_req = async_http_helpers.AsyncCogSearchHttpRequest(api_key, search_service_name, index_name, api_version, session=session)
+        self.session = session
+        self.index_name = index_name
+        self.all_fields = ['id', 'text', 'text_en', 'categoryId', 'file', 'class']
+        self.search_types = ['vector', 'hybrid', 'semantic_hybrid']
+        self.query_cache = QueryEmbeddingCache(query_cache_size, query_cache_ttl)
+
+
+
+    def get_cv(self):
+        return async_cv_helpers.AsyncCV(session=self.session)
+
+
+
+    async def create_index(self):
+
+        index_dict = copy.deepcopy(cs_json.create_index_json)
+        index_dict['name'] = self.index_name
+
+        await self.http_req.put(body = index_dict)
+
+
+    async def get_index(self):
+        return await self.http_req.get()
+
+
+    async def delete_index(self):
+        return await self.http_req.delete()
+
+
+    async def upload_documents(self, documents):
+
+        docs_dict = self.get_upload_json(documents)
+        await self.http_req.post(op ='index', body = docs_dict)
+
+        return docs_dict
+
+
+
+    async def upload_batch(self, batch, max_retries = 3):
+        """
+        Coroutine version of CogSearchVecStore.upload_batch
+        """
+        uploaded = 0
+        failed = []
+
+        for attempt in range(max_retries + 1):
+            results = await self.http_req.post(op ='index', body = {'value': batch})
+
+            retry_keys = set()
+            for r in results.get('value', []):
+                if r.get('status', False):
+                    uploaded += 1
+                elif (r.get('statusCode') in RETRYABLE_STATUS_CODES) and (attempt < max_retries):
+                    retry_keys.add(r['key'])
+                else:
+                    failed.append(r)
+
+            if not retry_keys:
+                return uploaded, failed
+
+            batch = [d for d in batch if d['id'] in retry_keys]
+            await asyncio.sleep(min(30, 2 ** attempt))
+
+        return uploaded, failed
+
+
+
+    async def bulk_upload_documents(self, documents, max_docs = MAX_BATCH_DOCS, max_bytes = MAX_BATCH_BYTES,
+                                    max_concurrency = 4, max_retries = 3, verbose = False):
+        """
+        Coroutine version of CogSearchVecStore.bulk_upload_documents, at most max_concurrency batches in flight
+        """
+        start = time.time()
+        stats = {'uploaded': 0, 'failed': [], 'batches': 0}
+        in_flight = set()
+
+        def collect(done):
+            for task in done:
+                in_flight.discard(task)
+                uploaded, failed = task.result()
+                stats['uploaded'] += uploaded
+                stats['failed'] += failed
+                stats['batches'] += 1
+                if verbose: print(f"Batch {stats['batches']}: {uploaded} uploaded, {len(failed)} failed")
+
+        try:
+            for batch in self.get_upload_batches(documents, max_docs, max_bytes):
+                if len(in_flight) >= max_concurrency:
+                    done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    collect(done)
+                in_flight.add(asyncio.ensure_future(self.upload_batch(batch, max_retries)))
+
+            if in_flight:
+                done, _ = await asyncio.wait(in_flight)
+                collect(done)
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+        stats['seconds'] = time.time() - start
+        stats['docs_per_sec'] = stats['uploaded'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+
+        if verbose: print(f"Uploaded {stats['uploaded']} documents in {stats['seconds']:.1f}s ({stats['docs_per_sec']:.1f} docs/sec), {len(stats['failed'])} failed")
+
+        return stats
+
+
+
+    async def delete_documents(self, op='index', ids = []):
+        docs_dict = self.get_delete_json(ids)
+        await self.http_req.post(op ='index', body = docs_dict)
+
+
+
+    async def get_query_vector(self, query, vector_name = None):
+        fields = "aoi_text_vector" if vector_name is None else vector_name
+
+        vector = self.query_cache.get(fields, query)
+        if vector is None:
+            fields, vector = await self.embed_query(query, vector_name)
+            self.query_cache.put(fields, query, vector)
+
+        return fields, vector
+
+
+
+    async def get_vector_fields(self, query, query_dict, vector_name = None):
+        query_dict['vector']['fields'], query_dict['vector']['value'] = await self.get_query_vector(query, vector_name)
+
+        return query_dict
+
+
+
+    async def embed_query(self, query, vector_name = None):
+        if (vector_name is None) or (vector_name == "aoi_text_vector"):
+            # the openai SDK is blocking, run it in the default executor
+            loop = asyncio.get_running_loop()
+            return "aoi_text_vector", await loop.run_in_executor(None, get_openai_embedding, query, 'text-embedding-ada-002')
+        elif vector_name == 'cv_text_vector':
+            return vector_name, await self.get_cv().get_text_embedding(query)
+        elif vector_name == 'cv_image_vector':
+            return vector_name, await self.get_cv().get_img_embedding(query)
+        else:
+            raise Exception(f'Invalid Vector Name {vector_name}')
+
+
+
+    async def iter_search_results(self, query, search_type = 'vector', vector_name = None, select = None, filter = None,
+                                  max_results = 1000, page_size = SEARCH_PAGE_SIZE, min_score = None):
+        """
+        Async generator version of CogSearchVecStore.iter_search_results: async for row in store.iter_search_results(...)
+        """
+        query_dict = self.get_search_json(query, search_type)
+        query_dict = await self.get_vector_fields(query, query_dict, vector_name)
+
+        skip = 0
+        while skip < max_results:
+            top = min(page_size, max_results - skip)
+            query_dict = self.set_query_options(query_dict, k = max_results, top = top, skip = skip, select = select, filter = filter)
+
+            results = (await self.http_req.post(op ='search', body = query_dict))['value']
+            for row in self.filter_results(results, top, min_score):
+                yield row
+
+            if len(results) < top:
+                break
+            skip += top
+
+
+
+    async def search(self, query, search_type = 'vector', vector_name = None, select=None, filter=None, verbose=False,
+                     embed_image_analysis = True, k = NUM_TOP_MATCHES, top = None, min_score = None):
+        """
+        Coroutine version of CogSearchVecStore.search (without the timings): for cv_image_vector the image URL
+        is embedded, and the embedding runs concurrently with the image analysis whenever it doesn't need the analysis text.
+        """
+        analysis = ''
+
+        if search_type not in self.search_types:
+            raise Exception(f"search_type must be one of {self.search_types}")
+
+        match = re.search(IMAGE_URL_REGEX, query)
+        query_vector = None
+
+        if match:
+            inp_url = match.group(1)
+            question = query.replace(inp_url, '')
+
+            if vector_name == 'cv_image_vector':
+                analysis, query_vector = await asyncio.gather(self.get_cv().analyze_image(img_url=inp_url),
+                                                              self.get_query_vector(inp_url, vector_name))
+            elif (not embed_image_analysis) and question.strip():
+                analysis, query_vector = await asyncio.gather(self.get_cv().analyze_image(img_url=inp_url),
+                                                              self.get_query_vector(question, vector_name))
+            else:
+                analysis = await self.get_cv().analyze_image(img_url=inp_url)
+
+            query = question + '\n' + analysis['text']
+
+        query_dict = self.get_search_json(query, search_type)
+
+        if query_vector is None:
+            query_vector = await self.get_query_vector(query, vector_name)
+
+        query_dict['vector']['fields'], query_dict['vector']['value'] = query_vector
+        query_dict = self.set_query_options(query_dict, k = k, top = top, select = select, filter = filter)
+
+        results = await self.http_req.post(op ='search', body = query_dict)
+        results = self.filter_results(results['value'], query_dict['top'], min_score)
+        if verbose: [print(r['@search.score']) for r in results]
+        if verbose: print(results)
+
+        context, links, scores = self.process_search_results(results)
+
+        if match:
+            return ['Analysis of the image in the question: ' + query + '\n\n'] + context, links, scores, analysis
+        else:
+            return context, links, scores, analysis
+
+
+
+    async def search_multi_vector(self, query, vector_names = VECTOR_FIELDS, weights = None, search_type = 'vector',
+                                  select = None, filter = None, k = NUM_TOP_MATCHES, top = None, min_score = None,
+                                  verbose = False):
+        """
+        Coroutine version of CogSearchVecStore.search_multi_vector (without the timings): the embeddings,
+        and with weights the per-field searches, run concurrently on the event loop
+        """
+        if search_type not in self.search_types:
+            raise Exception(f"search_type must be one of {self.search_types}")
+
+        inputs = self.get_multi_vector_inputs(query, vector_names)
+        if len(inputs) == 0:
+            raise Exception(f"Nothing to embed in the query for {vector_names}")
+
+        distinct = list(dict.fromkeys((text, embed_name) for _, text, embed_name in inputs))
+        embeddings = await asyncio.gather(*[self.get_query_vector(text, embed_name) for text, embed_name in distinct])
+        embeddings = {key: vector for key, (_, vector) in zip(distinct, embeddings)}
+
+        vector_queries = [{'value': embeddings[(text, embed_name)], 'fields': name, 'k': k}
+                          for name, text, embed_name in inputs]
+
+        query_dict = self.get_search_json(query, search_type)
+        del query_dict['vector']
+        top = k if top is None else top
+
+        if weights is None:
+            query_dict['vectors'] = vector_queries
+            query_dict = self.set_query_options(query_dict, k = k, top = top, select = select, filter = filter)
+            results = (await self.http_req.post(op ='search', body = query_dict))['value']
+        else:
+            weights = dict(zip(vector_names, weights))
+            results = await self.fuse_vector_searches(query_dict, vector_queries,
+                                                      [weights[vq['fields']] for vq in vector_queries], top, select, filter)
+
+        results = self.filter_results(results, top, min_score)
+        if verbose: [print(r['@search.score']) for r in results]
+
+        context, links, scores = self.process_search_results(results)
+
+        return context, links, scores, ''
+
+
+
+    async def fuse_vector_searches(self, query_dict, vector_queries, weights, top, select = None, filter = None):
+        """
+        Coroutine version of CogSearchVecStore.fuse_vector_searches
+        """
+        async def run(vector_query):
+            single_dict = {**query_dict, 'vector': vector_query}
+            single_dict = self.set_query_options(single_dict, k = vector_query['k'], top = vector_query['k'],
+                                                 select = select, filter = filter)
+            return (await self.http_req.post(op ='search', body = single_dict))['value']
+
+        ranked_results = await asyncio.gather(*[run(vector_query) for vector_query in vector_queries])
+
+        docs = {}
+        ranked_lists = []
+        for results in ranked_results:
+            ranked_lists.append([docs.setdefault(r.get('id') or r['file'], (len(docs), r))[0] for r in results])
+
+        by_row = {row: doc for row, doc in docs.values()}
+        rows, scores = reciprocal_rank_fusion(ranked_lists, weights)
+
+        return [{**by_row[row], '@search.score': float(score)} for row, score in zip(rows[:top], scores[:top])]
+
+
+
+    async def search_similar_images(self, query, analyze = False, select=None, filter=None, verbose=False,
+                                    k = NUM_TOP_MATCHES, top = None, min_score = None):
+
+        analysis = ''
+        search_type = 'vector'
+        vector_name = 'cv_image_vector'
+
+        match = re.search(IMAGE_URL_REGEX, query)
+
+        if match:
+            url = match.group(1)
+            query_dict = self.get_search_json(url, search_type)
+
+            # the image embedding and the optional analysis are independent
+            if analyze:
+                query_dict, analysis = await asyncio.gather(self.get_vector_fields(url, query_dict, vector_name),
+                                                            self.get_cv().analyze_image(img_url=url))
+            else:
+                query_dict = await self.get_vector_fields(url, query_dict, vector_name)
+
+            query_dict = self.set_query_options(query_dict, k = k, top = top, select = select, filter = filter)
+
+            results = await self.http_req.post(op ='search', body = query_dict)
+            results = self.filter_results(results['value'], query_dict['top'], min_score)
+            if verbose: [print(r['@search.score']) for r in results]
+
+            context, links, scores = self.process_search_results(results)
+
+            return context, links, scores, analysis
+
+        else:
+            return ["Sorry, no similar images have been found"], [], [], analysis
@@ -0,0 +1,115 @@
+import os
+import asyncio
+import numpy as np
+from dotenv import load_dotenv
+load_dotenv('../.env')
+
+from cog_search_vec_store import async_http_helpers
+from cog_search_vec_store import cv_helpers
+from embedding_cache import get_embedding_cache, image_key, url_key, text_key
+from image_preprocessing import read_image_file
+
+
+
+
+class AsyncCV(cv_helpers.CV):
+    """
+    Coroutine version of cv_helpers.CV, sharing its response processing and the embedding cache.
+    """
+
+    def __init__(self, api_key = os.getenv("azure_cv_key"),
+                       cog_serv_name  = os.getenv("azure_cv_endpoint"),
+                       api_version = "2023-02-01-preview",
+                       session = None):
+
+
+        self.http_req = async_http_helpers.AsyncCVHttpRequest(api_key, cog_serv_name, api_version, session=session)
+        self.model_version = f"{api_version}:latest"
+
+
+
+    async def analyze_image(self, img_url = None, filename = None, shrink = None):
+
+        if filename is not None:
+
+            data = await asyncio.get_running_loop().run_in_executor(None, read_image_file, filename, shrink)
+            response = await self.http_req.post(op='analyze', data=data)
+
+        else:
+            response = await self.http_req.post(op='analyze', headers=self.http_req.json_headers, body={'url': img_url})
+
+        response = self.process_json(img_url, response)
+
+        return response
+
+
+
+    async def get_img_embedding(self, img_url = None, filename = None, shrink = None):
+
+        if filename is not None:
+            # decoding and resizing is CPU bound, keep it off the event loop
+            data = await asyncio.get_running_loop().run_in_executor(None, read_image_file, filename, shrink)
+
+            key = image_key(data, self.model_version)
+            post = lambda: self.http_req.post(op='img_embedding', data=data)
+        else:
+            key = url_key(img_url, self.model_version)
+            post = lambda: self.http_req.post(op='img_embedding', headers=self.http_req.json_headers, body={'url': img_url})
+
+        return await self.get_or_compute(key, post)
+
+
+
+    async def get_text_embedding(self, text):
+        post = lambda: self.http_req.post(op='text_embedding', headers=self.http_req.json_headers, body={'text': text})
+
+        return await self.get_or_compute(text_key(text, self.model_version), post)
+
+
+
+    async def get_text_embeddings(self, texts, max_concurrency = cv_helpers.MAX_EMBEDDING_WORKERS):
+        """
+        Coroutine version of CV.get_text_embeddings, at most max_concurrency requests in flight
+        """
+        keys = [text_key(text, self.model_version) for text in texts]
+        unique = {}
+        for key, text in zip(keys, texts):
+            unique.setdefault(key, text)
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def embed(text):
+            async with semaphore:
+                return await self.get_text_embedding(text)
+
+        embeddings = dict(zip(unique, await asyncio.gather(*[embed(text) for text in unique.values()])))
+
+        missing = [unique[key] for key, embedding in embeddings.items() if embedding is None]
+        if missing:
+            raise Exception(f"No embedding returned for {len(missing)} texts, e.g. {missing[0]!r}")
+
+        if len(keys) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        return np.array([embeddings[key] for key in keys], dtype=np.float32)
+
+
+
+    async def get_or_compute(self, key, post):
+        """
+        Embedding cache lookup that never blocks the event loop: the in-memory tier is read directly,
+        the SQLite reads and writes run in the default executor
+        """
+        cache = get_embedding_cache()
+
+        embedding = cache.get_memory(key)
+        if embedding is not None:
+            return embedding
+
+        loop = asyncio.get_running_loop()
+        embedding = await loop.run_in_executor(None, cache.get, key)
+        if embedding is None:
+            embedding = self.get_vector(await post())
+            await loop.run_in_executor(None, cache.put, key, embedding)
+
+        return embedding
@@ -0,0 +1,184 @@
+import asyncio
+import json
+import weakref
+
+import aiohttp
+
+from tenacity import (
+    retry,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from cog_search_vec_store import http_helpers
+from cog_search_vec_store.http_helpers import HTTPError, CONNECT_TIMEOUT, READ_TIMEOUT, dumps
+
+
+POOL_MAXSIZE = 200
+
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+
+
+# aiohttp sessions are bound to an event loop, so there is one shared session per loop
+_shared_sessions = weakref.WeakKeyDictionary()
+
+
+def create_client_session(pool_maxsize = POOL_MAXSIZE, timeout = DEFAULT_TIMEOUT):
+    """
+    Create a keep-alive aiohttp.ClientSession. Must be called from a running event loop.
+    """
+    connector = aiohttp.TCPConnector(limit=pool_maxsize)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers={'Accept-Encoding': 'gzip, deflate'})
+
+
+def get_shared_client_session():
+    """
+    Session shared by all the async requests of the running event loop that don't get their own
+    """
+    loop = asyncio.get_running_loop()
+    session = _shared_sessions.get(loop)
+
+    if session is None or session.closed:
+        session = create_client_session()
+        _shared_sessions[loop] = session
+    return session
+
+
+async def close_shared_client_session():
+    session = _shared_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+
+class AsyncHTTPRequest:
+    def __init__(self, url = '', api_key = '', session = None):
+        self.url = url
+        self.api_key = api_key
+        self.default_headers = {'Content-Type': 'application/json', 'api-key': self.api_key}
+        self._session = session
+
+
+    @property
+    def session(self):
+        if self._session is None:
+            return get_shared_client_session()
+        return self._session
+
+
+    async def handle_response(self, response):
+        text = await response.text()
+
+        try:
+            response_data = json.loads(text)
+        except json.JSONDecodeError:
+            response_data = text
+
+        if response.status >= 400:
+            raise HTTPError(response.status, response_data)
+
+        return response_data
+
+
+    def get_url(self, op = None):
+        return self.url
+
+
+    def get_headers(self, headers = None):
+        if headers is None:
+            return self.default_headers
+        return {**self.default_headers, **headers}
+
+
+    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(4))
+    async def put(self, op = None, headers=None, body=None):
+
+        if body is None:
+            body = {}
+
+        async with self.session.put(self.get_url(op), data=dumps(body), headers=self.get_headers(headers)) as response:
+            return await self.handle_response(response)
+
+
+    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(4))
+    async def post(self, op = None, headers=None, body=None, data=None):
+
+        url = self.get_url(op)
+        headers = self.get_headers(headers)
+
+        if body is None:
+            body = {}
+
+        if data is not None:
+            request = self.session.post(url, data=data, headers=headers)
+        else:
+            request = self.session.post(url, data=dumps(body), headers=headers)
+
+        async with request as response:
+            return await self.handle_response(response)
+
+
+    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(2))
+    async def get(self, op = None, headers=None, params=None):
+
+        if params is None:
+            params = {}
+
+        async with self.session.get(self.get_url(op), headers=self.get_headers(headers), params=params) as response:
+            return await self.handle_response(response)
+
+
+    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(4))
+    async def delete(self, op = None, id = None, headers=None):
+
+        async with self.session.delete(self.get_url(op), headers=self.get_headers(headers)) as response:
+            return await self.handle_response(response)
+
+
+
+
+
+class AsyncCogSearchHttpRequest(AsyncHTTPRequest):
+
+    def __init__(self, api_key, search_service_name, index_name, api_version, session = None):
+        self.api_key = api_key
+        self.search_service_name = search_service_name
+        self.index_name = index_name
+        self.api_version = api_version
+        self.url        = f"{search_service_name}/indexes/{index_name}?api-version={api_version}"
+        self.post_url   = f"{search_service_name}/indexes/{index_name}/docs/index?api-version={api_version}"
+        self.search_url = f"{search_service_name}/indexes/{index_name}/docs/search?api-version={self.api_version}"
+
+        self.default_headers = {'Content-Type': 'application/json', 'api-key': self.api_key}
+        self._session = session
+
+
+    get_url = http_helpers.CogSearchHttpRequest.get_url
+
+
+
+class AsyncCVHttpRequest(AsyncHTTPRequest):
+
+    def __init__(self, api_key, cog_serv_name, api_version,
+                 options = ['tags', 'objects', 'caption', 'read', 'smartCrops', 'denseCaptions', 'people'],
+                 session = None):
+
+        self.api_key = api_key
+
+        if cog_serv_name.endswith('/'):
+            cog_serv_name = cog_serv_name[:-1]
+
+        self.cog_serv_name = cog_serv_name
+        self.api_version = api_version
+
+        options = ','.join(options).replace(' ', '') if isinstance(options, list) else options
+        self.url = f"{cog_serv_name}/computervision/imageanalysis:analyze?api-version={api_version}&modelVersion=latest&features={options}"
+        self.imgvec_url = f"{cog_serv_name}/computervision/retrieval:vectorizeImage?api-version={api_version}&modelVersion=latest"
+        self.txtvec_url = f"{cog_serv_name}/computervision/retrieval:vectorizeText?api-version={api_version}&modelVersion=latest"
+
+        self.default_headers = {'Content-type': 'application/octet-stream','Ocp-Apim-Subscription-Key': self.api_key}
+        self.json_headers = {'Content-type': 'application/json','Ocp-Apim-Subscription-Key': self.api_key}
+        self._session = session
+
+
+    get_url = http_helpers.CVHttpRequest.get_url
@@ -0,0 +1,375 @@
+"""
+Recall / latency / throughput benchmark for CogSearchVecStore.
+
+Builds synthetic indexes of increasing size, uploads them through bulk_upload_documents and runs
+search / search_similar_images queries, reporting upload docs/sec, QPS, p50/p95/p99 latency and
+recall@k against a brute-force NumPy search. Query embeddings are synthetic, no embedding API is called.
+
+    python -m cog_search_vec_store.benchmark --sizes 1000 10000 --vector_name aoi_text_vector --output bench.json
+
+With --builders, only micro-benchmarks the per-document cost of building upload / delete / search payloads,
+against the former deepcopy-of-template builders.
+
+Backends:
+    local   - local_index.LocalVectorIndex in-process
+    http    - the same local index behind a local HTTP stand-in of the search REST API
+    service - the Cognitive Search service in COG_SEARCH_ENDPOINT / COG_SEARCH_ADMIN_KEY (creates and deletes the index)
+"""
+
+import os
+import json
+import copy
+import time
+import uuid
+import argparse
+import threading
+import platform
+import socket
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+import numpy as np
+
+from cog_search_vec_store import cs_json
+from cog_search_vec_store.cogsearch_vecstore import CogSearchVecStore, NUM_TOP_MATCHES
+from cog_search_vec_store.http_helpers import HTTPError
+from cog_search_vec_store.local_index import LocalVectorIndex, normalize_rows
+
+
+IMAGE_VECTOR = 'cv_image_vector'
+QUERY_URL = "https://benchmark.local/queries/{}.jpg"
+
+
+
+class BenchmarkVecStore(CogSearchVecStore):
+    """
+    CogSearchVecStore whose query embeddings come from a table of synthetic vectors instead of the embedding APIs
+    """
+
+    def __init__(self, *args, dims = None, **kwargs):
+        super().__init__(*args, query_cache_size = 0, **kwargs)
+        self.dims = dims or {}
+        self.query_vectors = {}
+
+
+    def create_index(self):
+        index_dict = copy.deepcopy(cs_json.create_index_json)
+        index_dict['name'] = self.index_name
+        for field in index_dict['fields']:
+            if field['name'] in self.dims:
+                field['dimensions'] = self.dims[field['name']]
+
+        self.http_req.put(body = index_dict)
+
+
+    def embed_query(self, query, vector_name = None):
+        return vector_name or "aoi_text_vector", self.query_vectors[query.strip()]
+
+
+
+def make_handler(index):
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        """
+        Minimal stand-in of the search REST API backed by a LocalVectorIndex
+        """
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            # headers and body are written separately, avoid Nagle / delayed ACK stalls on keep-alive
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, obj, status = 200):
+            out = json.dumps(obj).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        def read_chunked(self):
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if size == 0:
+                    return b''.join(chunks)
+
+        def read_json(self):
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                return json.loads(self.read_chunked())
+            length = int(self.headers.get('Content-Length', 0))
+            return json.loads(self.rfile.read(length)) if length else {}
+
+        def handle_call(self, call):
+            try:
+                self.send_json(call())
+            except HTTPError as e:
+                self.send_json({'error': {'message': str(e.message)}}, e.status_code)
+
+        def do_PUT(self):
+            body = self.read_json()
+            self.handle_call(lambda: index.put(body=body))
+
+        def do_GET(self):
+            self.handle_call(index.get)
+
+        def do_DELETE(self):
+            self.handle_call(index.delete)
+
+        def do_POST(self):
+            body = self.read_json()
+            path = urlparse(self.path).path
+            op = 'search' if path.endswith('/docs/search') else 'index'
+            self.handle_call(lambda: index.post(op=op, body=body))
+
+    return StandInHandler
+
+
+def start_stand_in(index):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(index))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+
+def make_synthetic_vectors(n, dim, rng, n_clusters = 100, noise = 0.5):
+    """
+    Clustered unit vectors, closer to real embeddings than isotropic noise
+    """
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, n_clusters, n)] + noise * rng.normal(size=(n, dim)).astype(np.float32)
+    return normalize_rows(vectors)
+
+
+def make_queries(vectors, n_queries, rng, noise = 0.3):
+    queries = vectors[rng.integers(0, len(vectors), n_queries)]
+    return normalize_rows(queries + noise * normalize_rows(rng.normal(size=queries.shape)))
+
+
+def brute_force_topk(vectors, queries, k):
+    similarities = queries @ vectors.T
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    return [set(row) for row in top]
+
+
+def latency_stats(latencies, wall_time):
+    latencies = np.array(latencies) * 1000
+    return {
+        'queries': len(latencies),
+        'qps': len(latencies) / wall_time if wall_time > 0 else 0.0,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'mean_ms': float(latencies.mean()),
+    }
+
+
+def run_queries(call, queries, concurrency):
+    """
+    Run call(i) for every query index, returns the results, the latencies and the wall time
+    """
+    def timed_call(i):
+        start = time.perf_counter()
+        result = call(i)
+        return result, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outputs = list(executor.map(timed_call, range(len(queries))))
+    wall_time = time.perf_counter() - start
+
+    return [o[0] for o in outputs], [o[1] for o in outputs], wall_time
+
+
+def recall_at_k(links, truth, k):
+    hits = sum(len(set(int(l) for l in found[:k]) & expected) for found, expected in zip(links, truth))
+    return hits / (k * len(truth))
+
+
+
+def deepcopy_upload_doc_json(store, doc):
+    """
+    Upload document builder as it was before copy_doc_template, kept as the micro-benchmark baseline
+    """
+    doc_dict = copy.deepcopy(cs_json.upload_doc_json)
+
+    for k in store.all_fields:
+        doc_dict[k] = doc.get(k, '')
+
+    doc_dict['id'] = doc['id'] if doc.get('id', None) else str(uuid.uuid4())
+    doc_dict["aoi_text_vector"] = doc.get("aoi_text_vector", [])
+    doc_dict['cv_image_vector'] = doc.get('cv_image_vector', [])
+    doc_dict['cv_text_vector'] = doc.get('cv_text_vector', [])
+    doc_dict["@search.action"] = "upload"
+
+    return doc_dict
+
+
+def deepcopy_delete_doc_json(doc_id):
+    doc_dict = copy.deepcopy(cs_json.upload_doc_json)
+    doc_dict['id'] = doc_id
+    doc_dict["aoi_text_vector"] = [0] * 1536
+    doc_dict["@search.action"] = "delete"
+    return doc_dict
+
+
+def time_per_call(function, items, repeat = 5):
+    """
+    Best of repeat runs of function over items, in microseconds per item
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        best = min(best, time.perf_counter() - start)
+    return best / len(items) * 1e6
+
+
+def benchmark_builders(n_docs, dim, rng):
+    store = BenchmarkVecStore(None, None, 'bench-builders', backend = LocalVectorIndex('bench-builders'))
+    vectors = make_synthetic_vectors(n_docs, dim, rng).tolist()
+    docs = [{'id': str(i), 'text': '', 'text_en': f"document {i}", 'file': str(i), 'categoryId': '', 'class': '',
+             'aoi_text_vector': vectors[i]} for i in range(n_docs)]
+    ids = [d['id'] for d in docs]
+
+    assert all(deepcopy_upload_doc_json(store, d) == store.get_upload_doc_json(d) for d in docs[:100])
+    assert [deepcopy_delete_doc_json(i) for i in ids[:100]] == store.get_delete_json(ids[:100])['value']
+    for search_type, template in [('vector', cs_json.search_dict_vector), ('hybrid', cs_json.search_dict_hybrid),
+                                  ('semantic_hybrid', cs_json.search_dict_semantic_hybrid)]:
+        expected = copy.deepcopy(template)
+        if search_type != 'vector':
+            expected['search'] = 'query'
+        assert store.get_search_json('query', search_type) == expected
+
+    results = {
+        'upload_doc': (lambda d: deepcopy_upload_doc_json(store, d), store.get_upload_doc_json, docs),
+        'delete_doc': (deepcopy_delete_doc_json, lambda i: store.get_delete_json([i]), ids),
+        'search_json': (lambda q: copy.deepcopy(cs_json.search_dict_semantic_hybrid),
+                        lambda q: store.get_search_json(q, 'semantic_hybrid'), ids),
+    }
+
+    report = {}
+    for name, (before, after, items) in results.items():
+        before_us, after_us = time_per_call(before, items), time_per_call(after, items)
+        report[name] = {'deepcopy_us': before_us, 'builder_us': after_us, 'speedup': before_us / after_us}
+    return report
+
+
+
+def get_store(backend, index_name, dims):
+    server = None
+
+    if backend == 'local':
+        store = BenchmarkVecStore(None, None, index_name, backend = LocalVectorIndex(index_name), dims = dims)
+    elif backend == 'http':
+        server = start_stand_in(LocalVectorIndex(index_name))
+        store = BenchmarkVecStore('benchmark', f"http://127.0.0.1:{server.server_port}", index_name, dims = dims)
+    elif backend == 'service':
+        store = BenchmarkVecStore(os.getenv('COG_SEARCH_ADMIN_KEY'), os.getenv('COG_SEARCH_ENDPOINT'), index_name, dims = dims)
+    else:
+        raise ValueError(f"Unknown backend {backend}")
+
+    return store, server
+
+
+def benchmark_size(args, n_docs, rng):
+    k = NUM_TOP_MATCHES
+    dims = {args.vector_name: args.dim}
+    if args.similar_images:
+        dims.setdefault(IMAGE_VECTOR, args.image_dim)
+
+    store, server = get_store(args.backend, f"bench-{n_docs}", dims)
+    store.create_index()
+
+    vectors = {name: make_synthetic_vectors(n_docs, dim, rng) for name, dim in dims.items()}
+
+    def documents():
+        for i in range(n_docs):
+            doc = {'id': str(i), 'text': '', 'text_en': f"document {i}", 'file': str(i), 'categoryId': '', 'class': ''}
+            for name in dims:
+                doc[name] = vectors[name][i].tolist()
+            yield doc
+
+    upload = store.bulk_upload_documents(documents(), max_docs = args.batch_size, max_workers = args.upload_workers)
+    result = {'size': n_docs,
+              'upload': {'docs': upload['uploaded'], 'failed': len(upload['failed']), 'seconds': upload['seconds'],
+                         'docs_per_sec': upload['docs_per_sec']}}
+
+    # warm up lazily built structures (pending rows, IVF lists) outside of the timed queries
+    queries = make_queries(vectors[args.vector_name], args.queries, rng)
+    store.query_vectors = {f"q{i}": q.tolist() for i, q in enumerate(queries)}
+    store.search("q0", vector_name = args.vector_name)
+
+    links, latencies, wall_time = run_queries(lambda i: store.search(f"q{i}", vector_name = args.vector_name)[1],
+                                              queries, args.concurrency)
+    truth = brute_force_topk(vectors[args.vector_name], queries, k)
+    result['search'] = {**latency_stats(latencies, wall_time), f"recall@{k}": recall_at_k(links, truth, k)}
+
+    if args.similar_images:
+        queries = make_queries(vectors[IMAGE_VECTOR], args.queries, rng)
+        store.query_vectors = {QUERY_URL.format(i): q.tolist() for i, q in enumerate(queries)}
+
+        links, latencies, wall_time = run_queries(lambda i: store.search_similar_images(QUERY_URL.format(i))[1],
+                                                  queries, args.concurrency)
+        truth = brute_force_topk(vectors[IMAGE_VECTOR], queries, k)
+        result['search_similar_images'] = {**latency_stats(latencies, wall_time), f"recall@{k}": recall_at_k(links, truth, k)}
+
+    if args.backend == 'service':
+        store.delete_index()
+    if server is not None:
+        server.shutdown()
+
+    return result
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CogSearchVecStore search and upload")
+    parser.add_argument('--backend', choices=['local', 'http', 'service'], default='local')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--vector_name', default='aoi_text_vector', choices=['aoi_text_vector', 'cv_text_vector', 'cv_image_vector'])
+    parser.add_argument('--dim', type=int, default=None, help="1536 for ada (default for aoi_text_vector), 1024 for CV vectors")
+    parser.add_argument('--image_dim', type=int, default=1024)
+    parser.add_argument('--no_similar_images', dest='similar_images', action='store_false', help="Skip search_similar_images")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=1000)
+    parser.add_argument('--upload_workers', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--builders', action='store_true', help="Only micro-benchmark the payload builders, on max(sizes) documents")
+    parser.add_argument('--output', default=None, help="JSON file to write, prints to stdout if not given")
+    args = parser.parse_args()
+
+    if args.dim is None:
+        args.dim = 1536 if args.vector_name == 'aoi_text_vector' else 1024
+
+    rng = np.random.default_rng(args.seed)
+    report = {
+        'config': vars(args),
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine()},
+    }
+
+    if args.builders:
+        report['builders'] = benchmark_builders(max(args.sizes), args.dim, rng)
+    else:
+        report['results'] = [benchmark_size(args, n, rng) for n in args.sizes]
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -4,16 +4,126 @@ import logging
 import json
 import copy
 import re
+import time
+import threading
+
+from collections import OrderedDict
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from cog_search_vec_store import http_helpers
 from cog_search_vec_store import cs_json
 from cog_search_vec_store import cv_helpers
+from cog_search_vec_store.local_index import reciprocal_rank_fusion
 
 from utils import get_embedding, get_cosine_similarity, get_text_embedding
 from utils import get_openai_embedding, analyze_image, save_obj_to_pkl
 
 
 NUM_TOP_MATCHES = 5
+SEARCH_PAGE_SIZE = 50
+
+## fields read by process_search_results, the default select so that only those are transferred
+RESULT_FIELDS = ['id', 'text_en', 'file']
+
+## Cognitive Search accepts at most 1000 documents and 16 MB per indexing request
+MAX_BATCH_DOCS = 1000
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+MAX_FLOAT_JSON_BYTES = 26
+RETRYABLE_STATUS_CODES = [409, 422, 503]
+
+VECTOR_FIELDS = ['aoi_text_vector', 'cv_text_vector', 'cv_image_vector']
+
+QUERY_CACHE_SIZE = 4096
+QUERY_CACHE_TTL = 3600
+
+IMAGE_URL_REGEX = r"(https?:\/\/[^\/\s]+(?:\/[^\/\s]+)*\/[^?\/\s]+(?:\.jpg|\.jpeg|\.png)(?:\?[^\s'\"]+)?)"
+
+
+def timed(timings, stage, function, *args, **kwargs):
+    """
+    Call function and record its duration in seconds in timings[stage]
+    """
+    start = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+
+def copy_doc_template(template):
+    """
+    Copy of a cs_json document template, same keys in the same order. The templates only hold immutable
+    scalars and flat lists, so copying the lists is equivalent to a deepcopy at a fraction of the cost.
+    """
+    return {k: (list(v) if isinstance(v, list) else v) for k, v in template.items()}
+
+
+def copy_search_template(template):
+    """
+    Copy of a cs_json search template: the nested 'vector' dict gets its own copy, the other values are immutable
+    """
+    query_dict = template.copy()
+    query_dict['vector'] = copy_doc_template(template['vector'])
+    return query_dict
+
+
+
+class QueryEmbeddingCache:
+    """
+    LRU cache of query embeddings keyed by (vector_name, normalized query), with a time-to-live per entry
+    """
+
+    def __init__(self, max_size = QUERY_CACHE_SIZE, ttl = QUERY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get_key(self, vector_name, query):
+        return (vector_name or "aoi_text_vector", ' '.join(query.split()))
+
+
+    def get(self, vector_name, query):
+        key = self.get_key(vector_name, query)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is None) or (time.monotonic() - entry[0] > self.ttl):
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+
+    def put(self, vector_name, query, value):
+        if (self.max_size <= 0) or (value is None):
+            return
+
+        key = self.get_key(vector_name, query)
+
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
 
 
 class CogSearchVecStore:
@@ -21,13 +131,25 @@ class CogSearchVecStore:
     def __init__(self, api_key, 
                        search_service_name, 
                        index_name = "img-vec-index", 
-                       api_version = "2023-07-01-Preview"):
-
-
-        self.http_req = http_helpers.CogSearchHttpRequest(api_key, search_service_name, index_name, api_version)
+                       api_version = "2023-07-01-Preview",
+                       session = None,
+                       query_cache_size = QUERY_CACHE_SIZE,
+                       query_cache_ttl = QUERY_CACHE_TTL,
+                       backend = None):
+
+        ## backend is any object with the HTTPRequest put / get / delete / post interface,
+        ## e.g. local_index.LocalVectorIndex to serve the index in-process
+        if backend is None:
+            backend = http_helpers.CogSearchHttpRequest(api_key, search_service_name, index_name, api_version, session=session)
+
+        self.http_req = backend
+        self.session = getattr(backend, 'session', session)
         self.index_name = index_name
         self.all_fields = ['id', 'text', 'text_en', 'categoryId', 'file', 'class']
         self.search_types = ['vector', 'hybrid', 'semantic_hybrid']
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.last_timings = {}
+        self.query_cache = QueryEmbeddingCache(query_cache_size, query_cache_ttl)
 
 
 
@@ -49,140 +171,470 @@ class CogSearchVecStore:
 
     def upload_documents(self, documents):
 
-        docs_dict = copy.deepcopy(cs_json.upload_docs_json)
-
-        for doc in documents:
-            doc_dict = copy.deepcopy(cs_json.upload_doc_json)
-                        
-            for k in self.all_fields:
-                doc_dict[k] = doc.get(k, '')
-
-            doc_dict['id'] = doc['id'] if doc.get('id', None) else str(uuid.uuid4())
-            doc_dict["aoi_text_vector"] = doc.get("aoi_text_vector", [])
-            doc_dict['cv_image_vector'] = doc.get('cv_image_vector', [])
-            doc_dict['cv_text_vector'] = doc.get('cv_text_vector', [])
-            doc_dict["@search.action"] = "upload"
-            docs_dict['value'].append(doc_dict)
-        
+        docs_dict = self.get_upload_json(documents)
         self.http_req.post(op ='index', body = docs_dict)
 
         return docs_dict
 
 
 
+    def get_upload_json(self, documents):
+
+        return {'value': [self.get_upload_doc_json(doc) for doc in documents]}
+
+
+
+    def get_upload_doc_json(self, doc):
+
+        doc_dict = copy_doc_template(cs_json.upload_doc_json)
+
+        for k in self.all_fields:
+            doc_dict[k] = doc.get(k, '')
+
+        doc_dict['id'] = doc['id'] if doc.get('id', None) else str(uuid.uuid4())
+        doc_dict["aoi_text_vector"] = doc.get("aoi_text_vector", [])
+        doc_dict['cv_image_vector'] = doc.get('cv_image_vector', [])
+        doc_dict['cv_text_vector'] = doc.get('cv_text_vector', [])
+        doc_dict["@search.action"] = "upload"
+
+        return doc_dict
+
+
+
+    def estimate_doc_bytes(self, doc_dict):
+        """
+        Upper bound of the JSON size of an upload document, without serializing the vectors
+        """
+        vectors = ['aoi_text_vector', 'cv_image_vector', 'cv_text_vector']
+        size = len(json.dumps({k: v for k, v in doc_dict.items() if k not in vectors}))
+        size += sum(len(k) + 6 + MAX_FLOAT_JSON_BYTES * len(doc_dict[k]) for k in vectors if k in doc_dict)
+        return size
+
+
+
+    def get_upload_batches(self, documents, max_docs = MAX_BATCH_DOCS, max_bytes = MAX_BATCH_BYTES):
+        """
+        Generate lists of upload documents bounded by both the number of documents and the payload size
+        """
+        batch = []
+        batch_bytes = 0
+
+        for doc in documents:
+            doc_dict = self.get_upload_doc_json(doc)
+            doc_bytes = self.estimate_doc_bytes(doc_dict)
+
+            if batch and ((len(batch) >= max_docs) or (batch_bytes + doc_bytes > max_bytes)):
+                yield batch
+                batch = []
+                batch_bytes = 0
+
+            batch.append(doc_dict)
+            batch_bytes += doc_bytes
+
+        if batch:
+            yield batch
+
+
+
+    def upload_batch(self, batch, max_retries = 3):
+        """
+        Upload one batch. Documents that failed with a retryable status in the 207 response are re-sent alone.
+        Returns the number of uploaded documents and the list of failed document statuses.
+        """
+        uploaded = 0
+        failed = []
+
+        for attempt in range(max_retries + 1):
+            results = self.http_req.post(op ='index', body = {'value': batch})
+
+            retry_keys = set()
+            for r in results.get('value', []):
+                if r.get('status', False):
+                    uploaded += 1
+                elif (r.get('statusCode') in RETRYABLE_STATUS_CODES) and (attempt < max_retries):
+                    retry_keys.add(r['key'])
+                else:
+                    failed.append(r)
+
+            if not retry_keys:
+                return uploaded, failed
+
+            batch = [d for d in batch if d['id'] in retry_keys]
+            time.sleep(min(30, 2 ** attempt))
+
+        return uploaded, failed
+
+
+
+    def bulk_upload_documents(self, documents, max_docs = MAX_BATCH_DOCS, max_bytes = MAX_BATCH_BYTES,
+                              max_workers = 4, max_retries = 3, verbose = False):
+        """
+        Streaming bulk indexer: documents can be any iterator, batches are built lazily and
+        up to max_workers batches are uploaded concurrently.
+        Returns throughput statistics and the statuses of the documents that could not be indexed.
+        """
+        start = time.time()
+        stats = {'uploaded': 0, 'failed': [], 'batches': 0}
+
+        def collect(done):
+            for future in done:
+                in_flight.discard(future)
+                uploaded, failed = future.result()
+                stats['uploaded'] += uploaded
+                stats['failed'] += failed
+                stats['batches'] += 1
+                if verbose: print(f"Batch {stats['batches']}: {uploaded} uploaded, {len(failed)} failed")
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            in_flight = set()
+
+            for batch in self.get_upload_batches(documents, max_docs, max_bytes):
+                if len(in_flight) >= max_workers:
+                    collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+                in_flight.add(executor.submit(self.upload_batch, batch, max_retries))
+
+            collect(wait(in_flight).done)
+
+        stats['seconds'] = time.time() - start
+        stats['docs_per_sec'] = stats['uploaded'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+
+        if verbose: print(f"Uploaded {stats['uploaded']} documents in {stats['seconds']:.1f}s ({stats['docs_per_sec']:.1f} docs/sec), {len(stats['failed'])} failed")
+
+        return stats
+
+
+
     def delete_documents(self, op='index', ids = []):
-        docs_dict = copy.deepcopy(cs_json.upload_docs_json)
+        docs_dict = self.get_delete_json(ids)
+        self.http_req.post(op ='index', body = docs_dict)
+
+
+
+    def get_delete_json(self, ids):
+        docs_dict = {'value': []}
 
         for i in ids:
-            doc_dict = copy.deepcopy(cs_json.upload_doc_json)
+            doc_dict = copy_doc_template(cs_json.upload_doc_json)
             doc_dict['id'] = i
             doc_dict["aoi_text_vector"] = [0] * 1536 ## text-embedding-ada-002 dimensions
             doc_dict["@search.action"] = "delete"
             docs_dict['value'].append(doc_dict)
 
-        self.http_req.post(op ='index', body = docs_dict)
+        return docs_dict
 
 
 
     def get_search_json(self, query, search_type = 'vector'):
         if search_type == 'vector':
-            query_dict = copy.deepcopy(cs_json.search_dict_vector)
+            query_dict = copy_search_template(cs_json.search_dict_vector)
         elif search_type == 'hybrid':
-            query_dict = copy.deepcopy(cs_json.search_dict_hybrid)
+            query_dict = copy_search_template(cs_json.search_dict_hybrid)
             query_dict['search'] = query
         elif search_type == 'semantic_hybrid':
-            query_dict = copy.deepcopy(cs_json.search_dict_semantic_hybrid)
+            query_dict = copy_search_template(cs_json.search_dict_semantic_hybrid)
             query_dict['search'] = query
         return query_dict
 
             
-    def get_vector_fields(self, query, query_dict, vector_name = None):
+    def get_query_vector(self, query, vector_name = None):
+        fields = "aoi_text_vector" if vector_name is None else vector_name
+
+        vector = self.query_cache.get(fields, query)
+        if vector is None:
+            fields, vector = self.embed_query(query, vector_name)
+            self.query_cache.put(fields, query, vector)
+
+        return fields, vector
+
+
+    def embed_query(self, query, vector_name = None):
         if (vector_name is None) or (vector_name == "aoi_text_vector"):
-            query_dict['vector']['fields'] = "aoi_text_vector"
-            query_dict['vector']['value'] = get_openai_embedding(query, 'text-embedding-ada-002')    
+            return "aoi_text_vector", get_openai_embedding(query, 'text-embedding-ada-002')
         elif vector_name == 'cv_text_vector':
-            cvr = cv_helpers.CV()
-            query_dict['vector']['fields'] = vector_name
-            query_dict['vector']['value'] = cvr.get_text_embedding(query)
+            cvr = cv_helpers.CV(session=self.session)
+            return vector_name, cvr.get_text_embedding(query)
         elif vector_name == 'cv_image_vector':
-            cvr = cv_helpers.CV()
-            query_dict['vector']['fields'] = vector_name
-            query_dict['vector']['value'] = cvr.get_img_embedding(query)
+            cvr = cv_helpers.CV(session=self.session)
+            return vector_name, cvr.get_img_embedding(query)
         else:
             raise Exception(f'Invalid Vector Name {vector_name}')
-        
+
+
+    def get_vector_fields(self, query, query_dict, vector_name = None):
+        query_dict['vector']['fields'], query_dict['vector']['value'] = self.get_query_vector(query, vector_name)
+        return query_dict
+
+
+    def set_query_options(self, query_dict, k = NUM_TOP_MATCHES, top = None, skip = None, select = None, filter = None):
+        """
+        Number of nearest neighbours k, paging (top / skip, top defaults to k) and select projection are
+        applied by the service, so only the rows and fields that are used get transferred and parsed.
+        """
+        for vector_query in query_dict.get('vectors') or [query_dict['vector']]:
+            vector_query['k'] = k
+        query_dict['top'] = k if top is None else top
+        if skip:
+            query_dict['skip'] = skip
+        query_dict['filter'] = filter
+        query_dict['select'] = ', '.join(RESULT_FIELDS) if select is None else select
+
         return query_dict
 
 
+    def filter_results(self, results, top, min_score = None):
+        """
+        The 2023-07-01-Preview API has no similarity threshold, min_score is applied to the returned rows
+        """
+        results = results[:top]
+        if min_score is not None:
+            results = [r for r in results if r['@search.score'] >= min_score]
+        return results
 
-    def search(self, query, search_type = 'vector', vector_name = None, select=None, filter=None, verbose=False):
+
+    def iter_search_results(self, query, search_type = 'vector', vector_name = None, select = None, filter = None,
+                            max_results = 1000, page_size = SEARCH_PAGE_SIZE, min_score = None):
+        """
+        Generate the raw result rows of a query page by page (top / skip), up to max_results rows.
+        The query is embedded once, the vector query asks for max_results nearest neighbours.
+        """
+        query_dict = self.get_search_json(query, search_type)
+        query_dict['vector']['fields'], query_dict['vector']['value'] = self.get_query_vector(query, vector_name)
+
+        skip = 0
+        while skip < max_results:
+            top = min(page_size, max_results - skip)
+            query_dict = self.set_query_options(query_dict, k = max_results, top = top, skip = skip, select = select, filter = filter)
+
+            results = self.http_req.post(op ='search', body = query_dict)['value']
+            yield from self.filter_results(results, top, min_score)
+
+            if len(results) < top:
+                break
+            skip += top
+
+
+
+    def search(self, query, search_type = 'vector', vector_name = None, select=None, filter=None, verbose=False,
+               embed_image_analysis = True, return_timings = False, k = NUM_TOP_MATCHES, top = None, min_score = None):
+        """
+        k is the number of nearest neighbours of the vector query, top the number of results returned (defaults to k),
+        results scoring below min_score are dropped. select defaults to the fields used in the returned context.
+
+        When the query contains an image URL, the image analysis runs concurrently with the query embedding
+        whenever the embedding doesn't need the analysis text: for cv_image_vector (the image itself is embedded),
+        or for text vectors when embed_image_analysis is False (only the question text is embedded).
+
+        Per-stage timings in seconds (analysis, embedding, search, total) are kept in self.last_timings
+        and returned as a fifth element when return_timings is True.
+        """
         analysis = ''
+        timings = {}
+        start = time.perf_counter()
 
         if search_type not in self.search_types:
             raise Exception(f"search_type must be one of {self.search_types}")
 
-        regex = r"(https?:\/\/[^\/\s]+(?:\/[^\/\s]+)*\/[^?\/\s]+(?:\.jpg|\.jpeg|\.png)(?:\?[^\s'\"]+)?)"
-        match = re.search(regex, query)
+        match = re.search(IMAGE_URL_REGEX, query)
+        embedding_future = None
 
         if match:
             inp_url = match.group(1)
-            cvr = cv_helpers.CV()
-            analysis = cvr.analyze_image(img_url=inp_url)
-            query = query.replace(inp_url, '') + '\n' + analysis['text']
+            question = query.replace(inp_url, '')
+            cvr = cv_helpers.CV(session=self.session)
+            analysis_future = self.executor.submit(timed, timings, 'analysis', cvr.analyze_image, img_url=inp_url)
+
+            if vector_name == 'cv_image_vector':
+                embedding_future = self.executor.submit(timed, timings, 'embedding', self.get_query_vector, inp_url, vector_name)
+            elif (not embed_image_analysis) and question.strip():
+                embedding_future = self.executor.submit(timed, timings, 'embedding', self.get_query_vector, question, vector_name)
+
+            analysis = analysis_future.result()
+            query = question + '\n' + analysis['text']
 
         query_dict = self.get_search_json(query, search_type)
-        query_dict = self.get_vector_fields(query, query_dict, vector_name)
-        query_dict['vector']['k'] = f"{NUM_TOP_MATCHES}"
-        query_dict['filter'] = filter
-        query_dict['select'] = ', '.join(self.all_fields) if select is None else select
 
-        results = self.http_req.post(op ='search', body = query_dict)
-        results = results['value'][:NUM_TOP_MATCHES]
+        if embedding_future is None:
+            query_vector = timed(timings, 'embedding', self.get_query_vector, query, vector_name)
+        else:
+            query_vector = embedding_future.result()
+
+        query_dict['vector']['fields'], query_dict['vector']['value'] = query_vector
+        query_dict = self.set_query_options(query_dict, k = k, top = top, select = select, filter = filter)
+
+        results = timed(timings, 'search', self.http_req.post, op ='search', body = query_dict)
+        results = self.filter_results(results['value'], query_dict['top'], min_score)
         if verbose: [print(r['@search.score']) for r in results]
         if verbose: print(results)
 
         context, links, scores = self.process_search_results(results)
 
+        timings['total'] = time.perf_counter() - start
+        self.last_timings = timings
+        if verbose: print(timings)
+
         if match:
-            return ['Analysis of the image in the question: ' + query + '\n\n'] + context, links, scores, analysis
+            output = ['Analysis of the image in the question: ' + query + '\n\n'] + context, links, scores, analysis
         else:
-            return context, links, scores, analysis
+            output = context, links, scores, analysis
+
+        return (*output, timings) if return_timings else output
+
+
 
+    def get_multi_vector_inputs(self, query, vector_names):
+        """
+        What to embed, and how, for each vector field: (field, input, embedding vector_name).
+        CV text and image embeddings share one space, so a text query can search cv_image_vector through its
+        CV text embedding, and an image URL with no question can search cv_text_vector through its image embedding.
+        Fields that have nothing to embed (aoi_text_vector for a bare image URL) are skipped.
+        """
+        match = re.search(IMAGE_URL_REGEX, query)
+        url = match.group(1) if match else None
+        question = query.replace(url, '').strip() if url else query
 
+        inputs = []
+        for name in vector_names:
+            if name not in VECTOR_FIELDS:
+                raise Exception(f'Invalid Vector Name {name}')
 
-    def search_similar_images(self, query, analyze = False, select=None, filter=None, verbose=False):
+            if name == 'aoi_text_vector':
+                if question: inputs.append((name, question, name))
+            elif (name == 'cv_image_vector') and url:
+                inputs.append((name, url, name))
+            elif question:
+                inputs.append((name, question, 'cv_text_vector'))
+            else:
+                inputs.append((name, url, 'cv_image_vector'))
+
+        return inputs
+
+
+
+    def search_multi_vector(self, query, vector_names = VECTOR_FIELDS, weights = None, search_type = 'vector',
+                            select = None, filter = None, k = NUM_TOP_MATCHES, top = None, min_score = None,
+                            verbose = False, return_timings = False):
+        """
+        One search over several vector fields. The query is embedded for every field concurrently (each distinct
+        input / embedding model once). Without weights, a single multi-vector request is sent and the service
+        fuses the rankings with RRF. With weights (one per vector_name), one request per field is sent in parallel
+        and the rankings are fused client side with weighted RRF.
+
+        Returns context, links, scores and '' (no image analysis) like search, scores being the fused RRF scores.
+        """
+        timings = {}
+        start = time.perf_counter()
+
+        if search_type not in self.search_types:
+            raise Exception(f"search_type must be one of {self.search_types}")
+
+        inputs = self.get_multi_vector_inputs(query, vector_names)
+        if len(inputs) == 0:
+            raise Exception(f"Nothing to embed in the query for {vector_names}")
+
+        embedding_futures = {}
+        for _, text, embed_name in inputs:
+            if (text, embed_name) not in embedding_futures:
+                embedding_futures[(text, embed_name)] = self.executor.submit(self.get_query_vector, text, embed_name)
+
+        vector_queries = [{'value': embedding_futures[(text, embed_name)].result()[1], 'fields': name, 'k': k}
+                          for name, text, embed_name in inputs]
+        timings['embedding'] = time.perf_counter() - start
+
+        query_dict = self.get_search_json(query, search_type)
+        del query_dict['vector']
+        top = k if top is None else top
+
+        if weights is None:
+            query_dict['vectors'] = vector_queries
+            query_dict = self.set_query_options(query_dict, k = k, top = top, select = select, filter = filter)
+            results = timed(timings, 'search', self.http_req.post, op ='search', body = query_dict)['value']
+        else:
+            weights = dict(zip(vector_names, weights))
+            results = timed(timings, 'search', self.fuse_vector_searches, query_dict, vector_queries,
+                            [weights[vq['fields']] for vq in vector_queries], top, select, filter)
+
+        results = self.filter_results(results, top, min_score)
+        if verbose: [print(r['@search.score']) for r in results]
+
+        context, links, scores = self.process_search_results(results)
+
+        timings['total'] = time.perf_counter() - start
+        self.last_timings = timings
+        if verbose: print(timings)
+
+        output = context, links, scores, ''
+        return (*output, timings) if return_timings else output
+
+
+
+    def fuse_vector_searches(self, query_dict, vector_queries, weights, top, select = None, filter = None):
+        """
+        Run one search per vector query in parallel and fuse the rankings with weighted RRF
+        """
+        def run(vector_query):
+            single_dict = {**query_dict, 'vector': vector_query}
+            single_dict = self.set_query_options(single_dict, k = vector_query['k'], top = vector_query['k'],
+                                                 select = select, filter = filter)
+            return self.http_req.post(op ='search', body = single_dict)['value']
+
+        ranked_results = list(self.executor.map(run, vector_queries))
+
+        docs = {}
+        ranked_lists = []
+        for results in ranked_results:
+            ranked_lists.append([docs.setdefault(r.get('id') or r['file'], (len(docs), r))[0] for r in results])
+
+        by_row = {row: doc for row, doc in docs.values()}
+        rows, scores = reciprocal_rank_fusion(ranked_lists, weights)
+
+        return [{**by_row[row], '@search.score': float(score)} for row, score in zip(rows[:top], scores[:top])]
+
+
+
+    def search_similar_images(self, query, analyze = False, select=None, filter=None, verbose=False, return_timings = False,
+                              k = NUM_TOP_MATCHES, top = None, min_score = None):
 
         analysis = ''
+        timings = {}
+        start = time.perf_counter()
         search_type = 'vector'
         vector_name = 'cv_image_vector'
 
         if search_type not in self.search_types:
             raise Exception(f"search_type must be one of {self.search_types}")
 
-        regex = r"(https?:\/\/[^\/\s]+(?:\/[^\/\s]+)*\/[^?\/\s]+(?:\.jpg|\.jpeg|\.png)(?:\?[^\s'\"]+)?)"
-        match = re.search(regex, query)
+        match = re.search(IMAGE_URL_REGEX, query)
 
         if match:
             url = match.group(1)
             query_dict = self.get_search_json(url, search_type)
-            query_dict = self.get_vector_fields(url, query_dict, vector_name)
+
+            # the image embedding and the optional analysis are independent
             if analyze: 
-                cvr = cv_helpers.CV()
-                analysis = cvr.analyze_image(img_url=url)
-            query_dict['vector']['k'] = NUM_TOP_MATCHES
-            query_dict['filter'] = filter
-            query_dict['select'] = ', '.join(self.all_fields) if select is None else select
-
-            results = self.http_req.post(op ='search', body = query_dict)
-            results = results['value'][:NUM_TOP_MATCHES]
+                cvr = cv_helpers.CV(session=self.session)
+                analysis_future = self.executor.submit(timed, timings, 'analysis', cvr.analyze_image, img_url=url)
+
+            query_dict = timed(timings, 'embedding', self.get_vector_fields, url, query_dict, vector_name)
+
+            if analyze:
+                analysis = analysis_future.result()
+
+            query_dict = self.set_query_options(query_dict, k = k, top = top, select = select, filter = filter)
+
+            results = timed(timings, 'search', self.http_req.post, op ='search', body = query_dict)
+            results = self.filter_results(results['value'], query_dict['top'], min_score)
             if verbose: [print(r['@search.score']) for r in results]
 
             context, links, scores = self.process_search_results(results)
+            output = context, links, scores, analysis
 
-            return context, links, scores, analysis
-        
         else:
-            return ["Sorry, no similar images have been found"], [], [], analysis
+            output = ["Sorry, no similar images have been found"], [], [], analysis
+
+        timings['total'] = time.perf_counter() - start
+        self.last_timings = timings
+
+        return (*output, timings) if return_timings else output
 
 
 
@@ -191,7 +643,7 @@ class CogSearchVecStore:
     def process_search_results(self, results):
 
         if len(results) == 0:
-            return ["Sorry, I couldn't find any information related to the question."]
+            return ["Sorry, I couldn't find any information related to the question."], [], []
 
         context = []
         links = []
@@ -6,8 +6,17 @@ import uuid
 import logging
 import json
 import copy
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
 from cog_search_vec_store import http_helpers
+from embedding_cache import get_embedding_cache, image_key, url_key, text_key
+from image_preprocessing import read_image_file
+
 
+## vectorizeText takes a single text per request, get_text_embeddings fans out over this many requests
+MAX_EMBEDDING_WORKERS = 16
 
 
 
@@ -15,10 +24,12 @@ class CV:
 
     def __init__(self, api_key = os.getenv("azure_cv_key"), 
                        cog_serv_name  = os.getenv("azure_cv_endpoint"), 
-                       api_version = "2023-02-01-preview"):
+                       api_version = "2023-02-01-preview",
+                       session = None):
 
 
-        self.http_req = http_helpers.CVHttpRequest(api_key, cog_serv_name, api_version)
+        self.http_req = http_helpers.CVHttpRequest(api_key, cog_serv_name, api_version, session=session)
+        self.model_version = f"{api_version}:latest"
 
 
 
@@ -36,12 +47,11 @@ class CV:
 
 
 
-    def analyze_image(self, img_url = None, filename = None):
+    def analyze_image(self, img_url = None, filename = None, shrink = None):
 
         if filename is not None: 
         
-            with open(filename, 'rb') as f:
-                data = f.read()
+            data = read_image_file(filename, shrink)
             response = self.http_req.post(op='analyze', data=data)
 
         else:
@@ -52,27 +62,54 @@ class CV:
         return response
 
 
-    def get_img_embedding(self, img_url = None, filename = None):
+    def get_img_embedding(self, img_url = None, filename = None, shrink = None):
 
         if filename is not None: 
-            with open(filename, 'rb') as f:
-                data = f.read()
+            data = read_image_file(filename, shrink)
             
-            response = self.http_req.post(op='img_embedding', data=data)
+            key = image_key(data, self.model_version)
+            post = lambda: self.http_req.post(op='img_embedding', data=data)
         else:
+            key = url_key(img_url, self.model_version)
+            post = lambda: self.http_req.post(op='img_embedding', headers=self.http_req.json_headers, body={'url': img_url})
 
-            response = self.http_req.post(op='img_embedding', headers=self.http_req.json_headers, body={'url': img_url})
-
-        try:
-            return response['vector']
-        except:
-            return None
+        return get_embedding_cache().get_or_compute(key, lambda: self.get_vector(post()))
 
 
 
     def get_text_embedding(self, text):
-        response = self.http_req.post(op='text_embedding', headers=self.http_req.json_headers, body={'text': text})
+        post = lambda: self.http_req.post(op='text_embedding', headers=self.http_req.json_headers, body={'text': text})
+
+        return get_embedding_cache().get_or_compute(text_key(text, self.model_version), lambda: self.get_vector(post()))
+
+
+
+    def get_text_embeddings(self, texts, max_workers = MAX_EMBEDDING_WORKERS):
+        """
+        Embeddings of a list of texts as a float32 matrix, one row per text in input order.
+        Texts with the same cache key are embedded once, cache misses are requested concurrently
+        over the pooled session of self.http_req, at most max_workers at a time.
+        """
+        keys = [text_key(text, self.model_version) for text in texts]
+        unique = {}
+        for key, text in zip(keys, texts):
+            unique.setdefault(key, text)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique)))) as executor:
+            embeddings = dict(zip(unique, executor.map(self.get_text_embedding, unique.values())))
+
+        missing = [unique[key] for key, embedding in embeddings.items() if embedding is None]
+        if missing:
+            raise Exception(f"No embedding returned for {len(missing)} texts, e.g. {missing[0]!r}")
+
+        if len(keys) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        return np.array([embeddings[key] for key in keys], dtype=np.float32)
+
+
 
+    def get_vector(self, response):
         try:
             return response['vector']
         except:
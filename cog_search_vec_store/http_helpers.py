@@ -1,6 +1,13 @@
 import requests
 import json
+import threading
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from cog_search_vec_store.http_metrics import TimedHTTPAdapter, timed_request, record_attempt
 from tenacity import (
     retry,
     stop_after_attempt,
@@ -30,6 +37,92 @@ from tenacity import (
 # """
 
 
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+DEFAULT_TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 50
+
+
+## index batches with at least this many documents are sent as a chunked body, STREAM_CHUNK_DOCS documents per chunk
+STREAM_MIN_DOCS = 100
+STREAM_CHUNK_DOCS = 50
+
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def create_session(pool_connections = POOL_CONNECTIONS, pool_maxsize = POOL_MAXSIZE):
+    """
+    Create a keep-alive requests.Session with a connection pool per host and gzip responses
+    """
+    session = requests.Session()
+    adapter = TimedHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+    return session
+
+
+def get_shared_session():
+    """
+    Session shared by all the HTTPRequest instances (CogSearchVecStore, CV) that don't get their own
+    """
+    global _shared_session
+
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = create_session()
+    return _shared_session
+
+
+def configure_shared_session(pool_connections = POOL_CONNECTIONS, pool_maxsize = POOL_MAXSIZE):
+    """
+    Replace the shared session with one using a different pool size. Existing instances keep their session.
+    """
+    global _shared_session
+
+    with _shared_session_lock:
+        _shared_session = create_session(pool_connections, pool_maxsize)
+    return _shared_session
+
+
+
+def json_default(obj):
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    """
+    Serialize to compact JSON bytes. Uses orjson when it is installed (NumPy arrays are then serialized natively,
+    without going through Python floats), else the json module with NumPy arrays converted with tolist().
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=json_default, separators=(',', ':')).encode('utf-8')
+
+
+def iter_json_chunks(body, chunk_docs = STREAM_CHUNK_DOCS):
+    """
+    Serialize a {'value': [...], ...} body a few documents at a time, so the whole payload is never held in memory.
+    Passed to requests as a generator, it is sent with chunked transfer encoding.
+    """
+    rest = {k: v for k, v in body.items() if k != 'value'}
+    yield (dumps(rest)[:-1] + b',' if rest else b'{') + b'"value":['
+
+    docs = body['value']
+    for start in range(0, len(docs), chunk_docs):
+        chunk = b','.join(dumps(doc) for doc in docs[start:start + chunk_docs])
+        yield (b',' if start else b'') + chunk
+
+    yield b']}'
+
+
+
 class HTTPError(Exception):
     def __init__(self, status_code, message):
         self.status_code = status_code
@@ -39,10 +132,15 @@ class HTTPError(Exception):
 
 
 class HTTPRequest:
-    def __init__(self, url = '', api_key = ''):
+
+    stream_min_docs = STREAM_MIN_DOCS
+
+    def __init__(self, url = '', api_key = '', session = None, timeout = DEFAULT_TIMEOUT):
         self.url = url
         self.api_key = api_key
         self.default_headers = {'Content-Type': 'application/json', 'api-key': self.api_key}
+        self.session = get_shared_session() if session is None else session
+        self.timeout = timeout
         
         
     def initialize_for_cogsearch(self, api_key, search_service_name, index_name, api_version):
@@ -73,7 +171,19 @@ class HTTPRequest:
         return self.url
 
 
-    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(4))
+    def request(self, method, op, url, **kwargs):
+        """
+        Single attempt of a call, reported to the http_metrics request hooks
+        """
+        return timed_request(self.session, method, url, service=type(self).__name__, op=op, timeout=self.timeout, **kwargs)
+
+
+    def should_stream(self, body):
+        docs = body.get('value') if isinstance(body, dict) else None
+        return isinstance(docs, list) and (len(docs) >= self.stream_min_docs)
+
+
+    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(4), before=record_attempt)
     def put(self, op = None, headers=None, body=None):
         
         url = self.get_url(op)
@@ -86,11 +196,11 @@ class HTTPRequest:
         if body is None:
             body = {}
         
-        response = requests.put(url, json=body, headers=headers)
+        response = self.request('PUT', op, url, data=dumps(body), headers=headers)
         return self.handle_response(response)
 
 
-    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(4))
+    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(4), before=record_attempt)
     def post(self, op = None, headers=None, body=None, data=None):
 
         url = self.get_url(op)
@@ -104,16 +214,18 @@ class HTTPRequest:
             body = {}
         
         if data is not None:
-            response = requests.post(url, data=data, headers=headers)
+            response = self.request('POST', op, url, data=data, headers=headers)
+        elif self.should_stream(body):
+            response = self.request('POST', op, url, data=iter_json_chunks(body), headers=headers)
         elif body is not None:
-            response = requests.post(url, json=body, headers=headers)
+            response = self.request('POST', op, url, data=dumps(body), headers=headers)
         else:
-            response = requests.post(url, headers=headers)
+            response = self.request('POST', op, url, headers=headers)
 
         return self.handle_response(response)
 
 
-    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(2))
+    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(2), before=record_attempt)
     def get(self, op = None, headers=None, params=None):
 
         url = self.get_url(op)
@@ -126,11 +238,11 @@ class HTTPRequest:
         if params is None:
             params = {}
         
-        response = requests.get(url, headers=headers, params=params)
+        response = self.request('GET', op, url, headers=headers, params=params)
         return self.handle_response(response)
 
 
-    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(4))
+    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(4), before=record_attempt)
     def delete(self, op = None, id = None, headers=None):
 
         url = self.get_url(op)
@@ -140,7 +252,7 @@ class HTTPRequest:
         else:
             headers = {**self.default_headers, **headers}
         
-        response = requests.delete(url, headers=headers)
+        response = self.request('DELETE', op, url, headers=headers)
         return self.handle_response(response)
 
 
@@ -149,7 +261,7 @@ class HTTPRequest:
 
 class CogSearchHttpRequest(HTTPRequest):
 
-    def __init__(self, api_key, search_service_name, index_name, api_version):
+    def __init__(self, api_key, search_service_name, index_name, api_version, session = None, timeout = DEFAULT_TIMEOUT):
         self.api_key = api_key
         self.search_service_name = search_service_name
         self.index_name = index_name
@@ -159,6 +271,8 @@ class CogSearchHttpRequest(HTTPRequest):
         self.search_url = f"{search_service_name}/indexes/{index_name}/docs/search?api-version={self.api_version}"
         
         self.default_headers = {'Content-Type': 'application/json', 'api-key': self.api_key}
+        self.session = get_shared_session() if session is None else session
+        self.timeout = timeout
 
 
     def get_url(self, op = None):
@@ -176,7 +290,8 @@ class CogSearchHttpRequest(HTTPRequest):
 class CVHttpRequest(HTTPRequest):
 
     def __init__(self, api_key, cog_serv_name, api_version, 
-                 options = ['tags', 'objects', 'caption', 'read', 'smartCrops', 'denseCaptions', 'people']):
+                 options = ['tags', 'objects', 'caption', 'read', 'smartCrops', 'denseCaptions', 'people'],
+                 session = None, timeout = DEFAULT_TIMEOUT):
 
         self.api_key = api_key
 
@@ -193,6 +308,8 @@ class CVHttpRequest(HTTPRequest):
         
         self.default_headers = {'Content-type': 'application/octet-stream','Ocp-Apim-Subscription-Key': self.api_key}
         self.json_headers = {'Content-type': 'application/json','Ocp-Apim-Subscription-Key': self.api_key}
+        self.session = get_shared_session() if session is None else session
+        self.timeout = timeout
 
 
     def get_url(self, op = None):
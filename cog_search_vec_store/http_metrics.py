@@ -0,0 +1,358 @@
+"""
+Per-request instrumentation of http_helpers.HTTPRequest.
+
+Every attempt of an HTTPRequest call (tenacity retries included) produces an event dict, passed to the hooks
+registered with add_request_hook:
+
+    service, method, op, path      HTTPRequest subclass, HTTP method, HTTPRequest op and URL path
+    status, error                  HTTP status (None when no response was received) and exception, if any
+    attempt, retries               1-based attempt number of the call, and attempt - 1
+    new_connection                 True when the request opened a new pooled connection
+    dns_ms, connect_ms, tls_ms     name resolution, TCP connect and TLS handshake, None on a reused connection
+    ttfb_ms                        request sent to response headers received (connection set-up excluded)
+    total_ms                       whole attempt, body download included
+    request_bytes, response_bytes  request body size, response body size on the wire
+    throttling                     rate-limit and retry-after response headers (THROTTLING_HEADERS)
+
+    from cog_search_vec_store.http_metrics import LatencyHistogram, add_request_hook
+    histogram = LatencyHistogram()
+    add_request_hook(histogram.record)
+    ...
+    print(histogram.summary())
+"""
+
+import time
+import socket
+import logging
+import threading
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+
+
+THROTTLING_HEADERS = ['retry-after', 'retry-after-ms', 'x-ms-retry-after-ms',
+                      'x-ratelimit-remaining-requests', 'x-ratelimit-remaining-tokens',
+                      'x-ms-ratelimit-remaining-subscription-reads', 'x-ms-ratelimit-remaining-subscription-writes']
+
+## milliseconds, the OpenTelemetry default explicit bucket boundaries
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 75, 100, 250, 500, 750, 1000, 2500, 5000, 7500, 10000]
+
+
+_request_hooks = []
+_local = threading.local()
+
+
+
+def add_request_hook(hook):
+    """
+    Call hook(event) after every HTTPRequest attempt, from the thread that made the request
+    """
+    if hook not in _request_hooks:
+        _request_hooks.append(hook)
+    return hook
+
+
+def remove_request_hook(hook):
+    if hook in _request_hooks:
+        _request_hooks.remove(hook)
+
+
+def has_request_hooks():
+    return len(_request_hooks) > 0
+
+
+def emit(event):
+    for hook in list(_request_hooks):
+        try:
+            hook(event)
+        except Exception as e:
+            logging.warning(f"Request hook {hook} failed: {e}")
+
+
+def record_attempt(retry_state):
+    """
+    tenacity 'before' callback of the HTTPRequest methods, keeps the attempt number for the next event
+    """
+    _local.attempt = retry_state.attempt_number
+
+
+def get_attempt():
+    return getattr(_local, 'attempt', 1)
+
+
+
+def new_event(service, method, op, url):
+    return {
+        'service': service, 'method': method, 'op': op, 'path': urlparse(url).path,
+        'status': None, 'error': None, 'attempt': get_attempt(), 'retries': get_attempt() - 1,
+        'new_connection': False, 'dns_ms': None, 'connect_ms': None, 'tls_ms': None,
+        'ttfb_ms': None, 'total_ms': None, 'request_bytes': 0, 'response_bytes': 0, 'throttling': {},
+    }
+
+
+def get_body_size(data):
+    if data is None:
+        return 0
+    if isinstance(data, (bytes, bytearray, str)):
+        return len(data)
+    return None
+
+
+def count_chunks(chunks, event):
+    """
+    Pass through the chunks of a streamed body, adding their size to event['request_bytes']
+    """
+    for chunk in chunks:
+        event['request_bytes'] += len(chunk)
+        yield chunk
+
+
+def timed_request(session, method, url, service = None, op = None, data = None, **kwargs):
+    """
+    session.request with a request event emitted to the hooks. Without hooks, a plain session.request.
+    """
+    if not _request_hooks:
+        return session.request(method, url, data=data, **kwargs)
+
+    event = new_event(service, method, op, url)
+    size = get_body_size(data)
+    if size is None:
+        data = count_chunks(data, event)
+    else:
+        event['request_bytes'] = size
+
+    _local.event = event
+    start = time.perf_counter()
+
+    try:
+        response = session.request(method, url, data=data, **kwargs)
+    except Exception as e:
+        event['error'] = repr(e)
+        raise
+    else:
+        event['status'] = response.status_code
+        event['response_bytes'] = int(response.headers.get('Content-Length') or len(response.content))
+        event['throttling'] = {h: response.headers[h] for h in THROTTLING_HEADERS if h in response.headers}
+
+        setup_ms = sum(event[k] or 0 for k in ['dns_ms', 'connect_ms', 'tls_ms'])
+        event['ttfb_ms'] = max(0.0, response.elapsed.total_seconds() * 1000 - setup_ms)
+        return response
+    finally:
+        _local.event = None
+        event['total_ms'] = (time.perf_counter() - start) * 1000
+        emit(event)
+
+
+
+class TimedConnectionMixin:
+    """
+    Records name resolution and TCP connect times of new connections in the event of the current thread
+    """
+
+    def _new_conn(self):
+        event = getattr(_local, 'event', None)
+        if event is None:
+            return super()._new_conn()
+
+        start = time.perf_counter()
+        dns_host = self._dns_host
+        try:
+            # resolve here to time it, then connect to each resolved address in turn like urllib3's create_connection
+            addresses = socket.getaddrinfo(dns_host.strip('[]'), self.port, allowed_gai_family(), socket.SOCK_STREAM)
+        except (OSError, UnicodeError):
+            # urllib3 resolves again and raises its own error
+            return super()._new_conn()
+        resolved = time.perf_counter()
+
+        event['new_connection'] = True
+        event['dns_ms'] = (resolved - start) * 1000
+
+        error = None
+        try:
+            for address in list(dict.fromkeys(sockaddr[0] for *_, sockaddr in addresses)):
+                self._dns_host = address
+                try:
+                    sock = super()._new_conn()
+                    break
+                except (NewConnectionError, ConnectTimeoutError) as e:
+                    error = e
+            else:
+                raise error
+        finally:
+            self._dns_host = dns_host
+
+        event['connect_ms'] = (time.perf_counter() - resolved) * 1000
+        return sock
+
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+
+    def connect(self):
+        event = getattr(_local, 'event', None)
+        start = time.perf_counter()
+        super().connect()
+
+        if event is not None:
+            event['tls_ms'] = max(0.0, (time.perf_counter() - start) * 1000 - (event['dns_ms'] or 0) - (event['connect_ms'] or 0))
+
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose connections report their set-up times to the request events
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+
+
+class LatencyHistogram:
+    """
+    In-memory aggregation of request events per (service, op, method, status class), with fixed latency buckets.
+    Register it with add_request_hook(histogram.record).
+    """
+
+    def __init__(self, buckets = LATENCY_BUCKETS_MS):
+        self.buckets = list(buckets)
+        self.lock = threading.Lock()
+        self.series = defaultdict(self.new_series)
+
+
+    def new_series(self):
+        return {'count': 0, 'errors': 0, 'throttled': 0, 'retries': 0, 'new_connections': 0,
+                'request_bytes': 0, 'response_bytes': 0,
+                'total_ms': [0] * (len(self.buckets) + 1), 'ttfb_ms': [0] * (len(self.buckets) + 1),
+                'total_ms_sum': 0.0, 'ttfb_ms_sum': 0.0}
+
+
+    def get_bucket(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                return i
+        return len(self.buckets)
+
+
+    def record(self, event):
+        status = event['status']
+        key = (event['service'], event['op'], event['method'], f"{status // 100}xx" if status else 'error')
+
+        with self.lock:
+            series = self.series[key]
+            series['count'] += 1
+            series['errors'] += int((status is None) or (status >= 400))
+            series['throttled'] += int(status == 429)
+            series['retries'] += int(event['retries'] > 0)
+            series['new_connections'] += int(event['new_connection'])
+            series['request_bytes'] += event['request_bytes'] or 0
+            series['response_bytes'] += event['response_bytes'] or 0
+
+            for metric in ['total_ms', 'ttfb_ms']:
+                if event[metric] is not None:
+                    series[metric][self.get_bucket(event[metric])] += 1
+                    series[metric + '_sum'] += event[metric]
+
+
+    def get_percentile(self, counts, q):
+        """
+        Upper bound of the bucket holding the q-th percentile (the last bucket has no upper bound, inf)
+        """
+        total = sum(counts)
+        if total == 0:
+            return None
+
+        cumulative = 0
+        for i, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= q / 100 * total:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+
+
+    def summary(self):
+        """
+        Per series counts, mean and bucketed p50 / p95 / p99 of the total and time-to-first-byte latencies
+        """
+        with self.lock:
+            out = {}
+            for key, series in self.series.items():
+                stats = {k: v for k, v in series.items() if not isinstance(v, list) and not k.endswith('_sum')}
+                for metric in ['total_ms', 'ttfb_ms']:
+                    n = sum(series[metric])
+                    stats[metric] = {'mean': series[metric + '_sum'] / n if n else None,
+                                     **{f"p{q}": self.get_percentile(series[metric], q) for q in [50, 95, 99]}}
+                out['/'.join(str(k) for k in key)] = stats
+            return out
+
+
+    def reset(self):
+        with self.lock:
+            self.series.clear()
+
+
+
+class OpenTelemetryExporter:
+    """
+    Records the request events as OpenTelemetry metrics, with the HTTP client semantic convention attributes.
+    Needs the opentelemetry-api package, the SDK / exporter setup is left to the application.
+
+        add_request_hook(OpenTelemetryExporter().record)
+    """
+
+    def __init__(self, meter = None):
+        from opentelemetry import metrics
+
+        meter = meter or metrics.get_meter("cog_search_vec_store.http")
+
+        self.duration = meter.create_histogram("http.client.request.duration", unit="s", description="Duration of HTTP client requests")
+        self.ttfb = meter.create_histogram("http.client.time_to_first_byte", unit="s", description="Request sent to response headers received")
+        self.connect = meter.create_histogram("http.client.connection.duration", unit="s", description="DNS, TCP connect and TLS set-up of new connections")
+        self.request_size = meter.create_histogram("http.client.request.body.size", unit="By")
+        self.response_size = meter.create_histogram("http.client.response.body.size", unit="By")
+        self.retries = meter.create_counter("http.client.retries", description="Request attempts after the first one")
+        self.throttled = meter.create_counter("http.client.throttled", description="Responses with status 429")
+
+
+    def record(self, event):
+        attributes = {'http.request.method': event['method'], 'url.path': event['path'],
+                      'cog_search_vec_store.service': event['service'] or '', 'cog_search_vec_store.op': event['op'] or ''}
+        if event['status'] is not None:
+            attributes['http.response.status_code'] = event['status']
+        if event['error'] is not None:
+            attributes['error.type'] = event['error'].split('(')[0]
+
+        self.duration.record(event['total_ms'] / 1000, attributes)
+        if event['ttfb_ms'] is not None:
+            self.ttfb.record(event['ttfb_ms'] / 1000, attributes)
+        if event['new_connection']:
+            setup_ms = sum(event[k] or 0 for k in ['dns_ms', 'connect_ms', 'tls_ms'])
+            self.connect.record(setup_ms / 1000, attributes)
+
+        self.request_size.record(event['request_bytes'] or 0, attributes)
+        self.response_size.record(event['response_bytes'] or 0, attributes)
+
+        if event['retries'] > 0:
+            self.retries.add(1, attributes)
+        if event['status'] == 429:
+            self.throttled.add(1, attributes)
@@ -0,0 +1,597 @@
+import os
+import re
+import json
+import copy
+import math
+import threading
+
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from cog_search_vec_store.http_helpers import HTTPError
+
+
+## below this number of documents an exact scan is faster than probing an IVF index
+IVF_MIN_SIZE = 20000
+IVF_NPROBE = 16
+IVF_KMEANS_ITERATIONS = 10
+
+## BM25 parameters and reciprocal rank fusion constant used by the search service
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+TEXT_SEARCH_K = 50
+DEFAULT_TOP = 50
+
+TEXT_FIELDS = ['text', 'text_en']
+TOKEN_REGEX = re.compile(r"\w+")
+
+FILTER_TOKEN_REGEX = re.compile(r"\s*(?:(\()|(\))|'((?:[^']|'')*)'|(\w+))")
+
+
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def cosine_to_score(similarities):
+    """
+    Same relevance score as the search service for the cosine metric: 1 / (1 + cosine distance)
+    """
+    return 1.0 / (2.0 - np.clip(similarities, -1.0, 1.0))
+
+
+def tokenize_filter(filter):
+    """
+    Tokens of an OData filter: '(' / ')', ('string', value) for quoted literals and words (fields, operators)
+    """
+    tokens = []
+    position = 0
+    filter = filter.rstrip()
+
+    while position < len(filter):
+        m = FILTER_TOKEN_REGEX.match(filter, position)
+        if m is None:
+            raise HTTPError(400, f"Unsupported filter expression for the local index: {filter}")
+
+        if m.group(3) is not None:
+            tokens.append(('string', m.group(3).replace("''", "'")))
+        else:
+            tokens.append(m.group(1) or m.group(2) or m.group(4))
+        position = m.end()
+
+    return tokens
+
+
+def parse_filter(filter):
+    """
+    Parse a simple OData filter: comparisons "field eq 'value'" / "field ne 'value'" combined with
+    "and" / "or" ("and" binds tighter) and grouped with parentheses.
+    Returns the filter in disjunctive normal form: a list of or-clauses, each a list of (field, op, value).
+    """
+    if not filter or not filter.strip():
+        return []
+
+    tokens = tokenize_filter(filter)
+    position = 0
+
+    def error():
+        return HTTPError(400, f"Unsupported filter expression for the local index: {filter}")
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def parse_or():
+        nonlocal position
+        clauses = parse_and()
+        while peek() == 'or':
+            position += 1
+            clauses = clauses + parse_and()
+        return clauses
+
+    def parse_and():
+        nonlocal position
+        clauses = parse_primary()
+        while peek() == 'and':
+            position += 1
+            right = parse_primary()
+            clauses = [left_clause + right_clause for left_clause in clauses for right_clause in right]
+        return clauses
+
+    def parse_primary():
+        nonlocal position
+        if peek() == '(':
+            position += 1
+            clauses = parse_or()
+            if peek() != ')':
+                raise error()
+            position += 1
+            return clauses
+
+        if position + 3 > len(tokens):
+            raise error()
+
+        field, op, value = tokens[position:position + 3]
+        if not isinstance(field, str) or field in ('(', ')', 'and', 'or') or op not in ('eq', 'ne') or not isinstance(value, tuple):
+            raise error()
+
+        position += 3
+        return [[(field, op, value[1])]]
+
+    clauses = parse_or()
+    if position != len(tokens):
+        raise error()
+
+    return clauses
+
+
+
+def tokenize(text):
+    return TOKEN_REGEX.findall(text.lower())
+
+
+def reciprocal_rank_fusion(ranked_lists, weights = None, k = RRF_K):
+    """
+    Fuse ranked lists of rows: score(row) = sum of weight / (k + rank). Returns (rows, scores) best first.
+    """
+    if weights is None:
+        weights = [1.0] * len(ranked_lists)
+
+    fused = defaultdict(float)
+    for rows, weight in zip(ranked_lists, weights):
+        for rank, row in enumerate(rows):
+            fused[int(row)] += weight / (k + rank + 1)
+
+    ranked = sorted(fused.items(), key=lambda item: -item[1])
+    return np.array([r for r, _ in ranked], dtype=np.int64), np.array([s for _, s in ranked], dtype=np.float64)
+
+
+
+class BM25Index:
+    """
+    Inverted index over the searchable text of the documents, scored with BM25
+    """
+
+    def __init__(self, k1 = BM25_K1, b = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)
+        self.doc_terms = {}
+        self.doc_lengths = {}
+        self.total_length = 0
+
+
+    def add(self, row, text):
+        self.remove(row)
+
+        terms = Counter(tokenize(text))
+        self.doc_terms[row] = terms
+        self.doc_lengths[row] = sum(terms.values())
+        self.total_length += self.doc_lengths[row]
+
+        for term, tf in terms.items():
+            self.postings[term][row] = tf
+
+
+    def remove(self, row):
+        terms = self.doc_terms.pop(row, None)
+        if terms is None:
+            return
+
+        self.total_length -= self.doc_lengths.pop(row)
+        for term in terms:
+            del self.postings[term][row]
+            if not self.postings[term]:
+                del self.postings[term]
+
+
+    def search(self, query, mask, k = TEXT_SEARCH_K):
+        """
+        Top k rows allowed by mask by BM25 score. Returns (rows, scores).
+        """
+        n = len(self.doc_terms)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        avg_length = self.total_length / n
+        scores = defaultdict(float)
+
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for row, tf in postings.items():
+                if mask[row]:
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[row] / avg_length)
+                    scores[row] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: -item[1])[:k]
+        return np.array([r for r, _ in ranked], dtype=np.int64), np.array([s for _, s in ranked])
+
+
+
+class IVFFlatIndex:
+    """
+    Inverted-file index over unit vectors: spherical k-means centroids, exact scoring inside the probed lists.
+    """
+
+    def __init__(self, matrix, nlist = None, nprobe = IVF_NPROBE, iterations = IVF_KMEANS_ITERATIONS, seed = 0):
+        n = len(matrix)
+        self.nlist = nlist if nlist is not None else max(1, int(np.sqrt(n)))
+        self.nprobe = min(nprobe, self.nlist)
+
+        rng = np.random.default_rng(seed)
+        sample = matrix[rng.choice(n, size=min(n, self.nlist * 64), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=self.nlist, replace=False)]
+
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(self.nlist):
+                members = sample[assignment == c]
+                if len(members):
+                    centroids[c] = members.sum(axis=0)
+            centroids = normalize_rows(centroids)
+
+        self.centroids = centroids
+        assignment = np.argmax(matrix @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind='stable')
+        bounds = np.searchsorted(assignment[order], np.arange(self.nlist + 1))
+        self.lists = [order[bounds[c]:bounds[c + 1]] for c in range(self.nlist)]
+
+
+    def candidates(self, query):
+        probed = np.argpartition(-(self.centroids @ query), self.nprobe - 1)[:self.nprobe]
+        return np.concatenate([self.lists[c] for c in probed])
+
+
+
+class LocalVectorIndex:
+    """
+    In-process replacement for CogSearchHttpRequest, so CogSearchVecStore can run without the search service:
+
+        store = CogSearchVecStore(None, None, backend = LocalVectorIndex('img-vec-index', persist_dir = 'local-index'))
+
+    It answers the same put / get / delete / post(op='index' | 'search') calls with the same JSON payloads.
+    Vector search is exact for small indexes and uses an IVF-flat index above ivf_min_size documents.
+    A 'search' text in the query is ranked with BM25 over text_fields and fused with the vector results
+    by reciprocal rank fusion, like the service's hybrid mode (semantic_hybrid runs as plain hybrid).
+    Filters support eq / ne comparisons on string fields (categoryId, class, ...) combined with and / or.
+    """
+
+    def __init__(self, index_name = "img-vec-index", persist_dir = None, ivf_min_size = IVF_MIN_SIZE, nprobe = IVF_NPROBE,
+                 text_fields = TEXT_FIELDS):
+        self.index_name = index_name
+        self.text_fields = text_fields
+        self.persist_dir = persist_dir
+        self.ivf_min_size = ivf_min_size
+        self.nprobe = nprobe
+        self.lock = threading.RLock()
+
+        self.reset()
+
+        if (persist_dir is not None) and os.path.exists(os.path.join(persist_dir, 'index.json')):
+            self.load()
+
+
+    def reset(self, index_dict = None):
+        self.index_dict = index_dict
+        self.vector_fields = {}
+        if index_dict is not None:
+            self.vector_fields = {f['name']: f['dimensions'] for f in index_dict['fields'] if f.get('dimensions')}
+
+        self.docs = []
+        self.id_to_row = {}
+        self.alive = np.zeros(0, dtype=bool)
+        self.vectors = {name: np.zeros((0, dim), dtype=np.float32) for name, dim in self.vector_fields.items()}
+        self.has_vector = {name: np.zeros(0, dtype=bool) for name in self.vector_fields}
+        self.pending = []
+        self.ivf = {}
+        self.columns = {}
+        self.bm25 = BM25Index()
+
+
+    def get_text(self, doc):
+        return ' '.join(str(doc.get(f) or '') for f in self.text_fields)
+
+
+    def get_url(self, op = None):
+        return f"local://{self.index_name}/{op or ''}"
+
+
+    ### HTTPRequest interface
+
+    def put(self, op = None, headers=None, body=None):
+        with self.lock:
+            self.reset(copy.deepcopy(body))
+        return body
+
+
+    def get(self, op = None, headers=None, params=None):
+        if self.index_dict is None:
+            raise HTTPError(404, f"No index named {self.index_name}")
+        return self.index_dict
+
+
+    def delete(self, op = None, id = None, headers=None):
+        with self.lock:
+            self.reset()
+        return ''
+
+
+    def post(self, op = None, headers=None, body=None, data=None):
+        if self.index_dict is None:
+            raise HTTPError(404, f"No index named {self.index_name}")
+
+        if op == 'index':
+            return self.index_documents(body['value'])
+        elif op == 'search':
+            return self.search(body)
+        else:
+            raise HTTPError(400, f"Unsupported operation for the local index: {op}")
+
+
+    ### indexing
+
+    def index_documents(self, docs):
+        results = []
+
+        with self.lock:
+            for doc in docs:
+                action = doc.get('@search.action', 'upload')
+                key = doc['id']
+
+                if action == 'delete':
+                    row = self.id_to_row.pop(key, None)
+                    if row is not None:
+                        self.flush_pending()
+                        self.alive[row] = False
+                        self.docs[row] = None
+                        self.bm25.remove(row)
+                    results.append({'key': key, 'status': True, 'errorMessage': None, 'statusCode': 200})
+                    continue
+
+                fields = {k: v for k, v in doc.items() if (k != '@search.action') and (k not in self.vector_fields)}
+                vectors = {k: doc.get(k) for k in self.vector_fields}
+
+                error = self.check_dimensions(vectors)
+                if error is not None:
+                    results.append({'key': key, 'status': False, 'errorMessage': error, 'statusCode': 400})
+                    continue
+
+                if action in ('merge', 'mergeOrUpload') and key in self.id_to_row:
+                    old = self.docs[self.id_to_row[key]]
+                    fields = {**old, **fields}
+                    vectors = {k: v for k, v in vectors.items() if (v is not None) and (len(v) > 0)}
+                elif action == 'merge':
+                    results.append({'key': key, 'status': False, 'errorMessage': 'Document not found.', 'statusCode': 404})
+                    continue
+
+                self.upsert(key, fields, vectors)
+                results.append({'key': key, 'status': True, 'errorMessage': None, 'statusCode': 201})
+
+            self.ivf = {}
+            self.columns = {}
+
+        return {'value': results}
+
+
+    def check_dimensions(self, vectors):
+        """
+        Error message for a vector whose length doesn't match the dimensions of its field, like the service rejects it
+        """
+        for name, vector in vectors.items():
+            if (vector is not None) and (len(vector) > 0) and (len(vector) != self.vector_fields[name]):
+                return f"The vector field '{name}' must have {self.vector_fields[name]} dimensions, got {len(vector)}."
+        return None
+
+
+    def upsert(self, key, fields, vectors):
+        row = self.id_to_row.get(key)
+
+        if row is None:
+            row = len(self.docs)
+            self.docs.append(fields)
+            self.id_to_row[key] = row
+            self.pending.append((row, vectors))
+            self.bm25.add(row, self.get_text(fields))
+            return
+
+        self.flush_pending()
+        self.docs[row] = fields
+        self.bm25.add(row, self.get_text(fields))
+        for name, vector in vectors.items():
+            if vector is None:
+                continue
+            has_vector = len(vector) > 0
+            self.has_vector[name][row] = has_vector
+            self.vectors[name][row] = normalize_rows(vector) if has_vector else 0.0
+
+
+    def flush_pending(self):
+        """
+        Append the rows uploaded since the last search in one concatenation per vector field
+        """
+        if not self.pending:
+            return
+
+        n = len(self.pending)
+        self.alive = np.concatenate([self.alive, np.ones(n, dtype=bool)])
+
+        for name, dim in self.vector_fields.items():
+            block = np.zeros((n, dim), dtype=np.float32)
+            present = np.zeros(n, dtype=bool)
+            for i, (_, vectors) in enumerate(self.pending):
+                vector = vectors.get(name)
+                if vector is not None and len(vector) > 0:
+                    block[i] = vector
+                    present[i] = True
+            self.vectors[name] = np.concatenate([self.vectors[name], normalize_rows(block)])
+            self.has_vector[name] = np.concatenate([self.has_vector[name], present])
+
+        self.pending = []
+
+
+    ### search
+
+    def get_filter_mask(self, filter):
+        mask = self.alive.copy()
+        clauses = parse_filter(filter)
+        if not clauses:
+            return mask
+
+        matches = np.zeros(len(self.docs), dtype=bool)
+        for clause in clauses:
+            clause_matches = np.ones(len(self.docs), dtype=bool)
+            for field, op, value in clause:
+                equal = self.get_column(field) == value
+                clause_matches &= equal if op == 'eq' else ~equal
+            matches |= clause_matches
+
+        return mask & matches
+
+
+    def get_column(self, field):
+        """
+        Values of a field for all the rows as a numpy array, cached until the next write
+        """
+        if field not in self.columns:
+            self.columns[field] = np.array([str(doc.get(field, '')) if doc is not None else '' for doc in self.docs], dtype=object)
+        return self.columns[field]
+
+
+    def get_ivf(self, vector_name):
+        if vector_name not in self.ivf:
+            rows = np.flatnonzero(self.has_vector[vector_name])
+            index = IVFFlatIndex(self.vectors[vector_name][rows], nprobe=self.nprobe)
+            index.lists = [rows[l] for l in index.lists]
+            self.ivf[vector_name] = index
+        return self.ivf[vector_name]
+
+
+    def vector_search(self, vector_name, value, k, mask):
+        """
+        Top k rows by cosine similarity among the rows allowed by mask. Returns (rows, scores).
+        """
+        if vector_name not in self.vector_fields:
+            raise HTTPError(400, f"Unknown vector field {vector_name}")
+
+        query = normalize_rows(value)
+        mask = mask & self.has_vector[vector_name]
+
+        if mask.sum() >= self.ivf_min_size:
+            rows = self.get_ivf(vector_name).candidates(query)
+            rows = rows[mask[rows]]
+            if len(rows) < k:
+                rows = np.flatnonzero(mask)
+        else:
+            rows = np.flatnonzero(mask)
+
+        if len(rows) == 0:
+            return rows, np.zeros(0, dtype=np.float32)
+
+        similarities = self.vectors[vector_name][rows] @ query
+        k = min(k, len(rows))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top], kind='stable')]
+
+        return rows[top], cosine_to_score(similarities[top])
+
+
+    def get_vector_queries(self, body):
+        if body.get('vectors'):
+            return body['vectors']
+        if body.get('vector') and len(body['vector'].get('value') or []) > 0:
+            return [body['vector']]
+        return []
+
+
+    def select_fields(self, doc, select):
+        if (select is None) or (select.strip() == '*'):
+            return dict(doc)
+        fields = [f.strip() for f in select.split(',')]
+        return {f: doc.get(f) for f in fields if (f in doc) and (f not in self.vector_fields)}
+
+
+    def search(self, body):
+        with self.lock:
+            self.flush_pending()
+            mask = self.get_filter_mask(body.get('filter'))
+
+            vector_queries = self.get_vector_queries(body)
+            text = body.get('search')
+            has_text = (text is not None) and (text.strip() not in ('', '*'))
+
+            if not vector_queries and not has_text:
+                raise HTTPError(400, "The local index needs a vector query or a search text")
+
+            ranked = [self.vector_search(vq['fields'], vq['value'], int(vq.get('k') or DEFAULT_TOP), mask) for vq in vector_queries]
+            if has_text:
+                ranked.append(self.bm25.search(text, mask))
+
+            if len(ranked) == 1:
+                rows, scores = ranked[0]
+            else:
+                rows, scores = reciprocal_rank_fusion([r for r, _ in ranked])
+
+            top = body.get('top')
+            if top is None and len(ranked) > 1:
+                top = DEFAULT_TOP
+            skip = int(body.get('skip') or 0)
+            end = None if top is None else skip + int(top)
+            rows, scores = rows[skip:end], scores[skip:end]
+
+            value = []
+            for row, score in zip(rows, scores):
+                doc = self.select_fields(self.docs[row], body.get('select'))
+                doc['@search.score'] = float(score)
+                value.append(doc)
+
+        return {'value': value}
+
+
+    ### persistence
+
+    def save(self, persist_dir = None):
+        persist_dir = persist_dir or self.persist_dir
+        if persist_dir is None:
+            raise ValueError("No persist_dir given")
+
+        os.makedirs(persist_dir, exist_ok=True)
+
+        with self.lock:
+            self.flush_pending()
+            rows = np.flatnonzero(self.alive)
+
+            np.savez(os.path.join(persist_dir, 'vectors.npz'),
+                     **{f"{name}": self.vectors[name][rows] for name in self.vector_fields},
+                     **{f"has_{name}": self.has_vector[name][rows] for name in self.vector_fields})
+
+            with open(os.path.join(persist_dir, 'index.json'), 'w') as f:
+                json.dump({'index': self.index_dict, 'docs': [self.docs[r] for r in rows]}, f)
+
+
+    def load(self, persist_dir = None):
+        persist_dir = persist_dir or self.persist_dir
+
+        with open(os.path.join(persist_dir, 'index.json'), 'r') as f:
+            saved = json.load(f)
+
+        with self.lock:
+            self.reset(saved['index'])
+            self.docs = saved['docs']
+            self.id_to_row = {doc['id']: i for i, doc in enumerate(self.docs)}
+            self.alive = np.ones(len(self.docs), dtype=bool)
+            for row, doc in enumerate(self.docs):
+                self.bm25.add(row, self.get_text(doc))
+
+            if self.vector_fields:
+                with np.load(os.path.join(persist_dir, 'vectors.npz')) as arrays:
+                    for name in self.vector_fields:
+                        self.vectors[name] = arrays[name]
+                        self.has_vector[name] = arrays[f"has_{name}"]
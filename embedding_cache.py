@@ -0,0 +1,198 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+DEFAULT_CACHE_FILE = os.getenv("EMBEDDING_CACHE_FILE", os.path.join(os.path.expanduser("~"), ".cache", "gen-cv", "embedding-cache.sqlite"))
+DEFAULT_MAX_MEMORY_ITEMS = 10000
+DEFAULT_MAX_DISK_BYTES = 1024 ** 3
+
+CV_MODEL_VERSION = "2023-02-01-preview:latest"
+
+
+
+def image_key(data, model_version = CV_MODEL_VERSION, namespace = 'cv-image'):
+    """
+    Cache key of an image: hash of the image bytes plus the model version
+    """
+    return f"{namespace}:{model_version}:{hashlib.sha256(data).hexdigest()}"
+
+
+def url_key(url, model_version = CV_MODEL_VERSION, namespace = 'cv-image-url'):
+    """
+    Cache key of an image referenced by URL (the bytes are never downloaded locally)
+    """
+    return f"{namespace}:{model_version}:{hashlib.sha256(url.encode('utf-8')).hexdigest()}"
+
+
+def text_key(text, model_version = CV_MODEL_VERSION, namespace = 'cv-text'):
+    """
+    Cache key of a text: hash of the whitespace-normalized text plus the model version
+    """
+    normalized = re.sub(r'\s+', ' ', text).strip()
+    return f"{namespace}:{model_version}:{hashlib.sha256(normalized.encode('utf-8')).hexdigest()}"
+
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache: an in-process LRU in front of a SQLite file.
+
+    Embeddings are stored as float32 blobs and evicted least-recently-used first once
+    the SQLite tier grows above max_disk_bytes. Safe to share between threads.
+    """
+
+    def __init__(self, cache_file = DEFAULT_CACHE_FILE,
+                       max_memory_items = DEFAULT_MAX_MEMORY_ITEMS,
+                       max_disk_bytes = DEFAULT_MAX_DISK_BYTES):
+
+        self.cache_file = cache_file
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+
+        self.memory = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+        if cache_file != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+
+        self.conn = sqlite3.connect(cache_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings (last_access)")
+        self.conn.commit()
+
+        self.disk_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+
+    def _remember(self, key, embedding):
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+
+    def get_memory(self, key):
+        """
+        Get an embedding from the in-process tier only, without touching SQLite (safe to call from an event loop)
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+        return None
+
+
+    def get(self, key):
+        """
+        Get a cached embedding as a list of floats, or None
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+            row = self.conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.conn.execute("UPDATE embeddings SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+
+            embedding = np.frombuffer(row[0], dtype=np.float32).tolist()
+            self._remember(key, embedding)
+            self.hits += 1
+            return embedding
+
+
+    def put(self, key, embedding):
+        if embedding is None:
+            return
+
+        blob = np.asarray(embedding, dtype=np.float32).tobytes()
+
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM embeddings WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO embeddings (key, vector, size, last_access) VALUES (?, ?, ?, ?)",
+                              (key, blob, len(blob), time.time()))
+            self.disk_bytes += len(blob) - (old[0] if old else 0)
+            self._evict()
+            self.conn.commit()
+
+            self._remember(key, list(embedding))
+
+
+    def _evict(self):
+        if self.disk_bytes <= self.max_disk_bytes:
+            return
+
+        target = int(self.max_disk_bytes * 0.9)
+        rows = self.conn.execute("SELECT key, size FROM embeddings ORDER BY last_access").fetchall()
+
+        evicted = []
+        for key, size in rows:
+            if self.disk_bytes <= target:
+                break
+            evicted.append((key,))
+            self.disk_bytes -= size
+            self.memory.pop(key, None)
+
+        self.conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+
+
+    def get_or_compute(self, key, compute_function):
+        """
+        Return the cached embedding for key, calling compute_function() and caching its result on a miss
+        """
+        embedding = self.get(key)
+        if embedding is None:
+            embedding = compute_function()
+            self.put(key, embedding)
+        return embedding
+
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.conn.execute("DELETE FROM embeddings")
+            self.conn.commit()
+            self.disk_bytes = 0
+
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'memory_items': len(self.memory), 'disk_bytes': self.disk_bytes}
+
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """
+    Process-wide EmbeddingCache shared by utils, cv_helpers and the workshop helpers
+    """
+    global _default_cache
+
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache()
+    return _default_cache
@@ -0,0 +1,262 @@
+import os
+import json
+import pickle
+import itertools
+import argparse
+
+import numpy as np
+
+
+VECTORS_FILE = 'vectors.npy'
+PATHS_FILE = 'paths.jsonl'
+HEADER_FILE = 'store.json'
+
+MIN_CAPACITY = 1024
+
+
+
+class EmbeddingStore:
+    """
+    On-disk embedding store: a float32 .npy matrix opened as a memmap plus a sidecar table of image paths.
+
+    Layout of the store directory:
+        store.json   - dim and number of rows in use
+        vectors.npy  - float32 matrix of shape (capacity, dim), only the first `count` rows are valid
+        paths.jsonl  - one JSON record per row: {"path": ..., **metadata}
+
+    Opening a store only maps the matrix, nothing is read until rows are accessed.
+    """
+
+    def __init__(self, store_dir, mode = 'r'):
+
+        if mode not in ('r', 'r+'):
+            raise ValueError(f"mode must be 'r' or 'r+', got {mode}")
+
+        self.store_dir = store_dir
+        self.mode = mode
+
+        with open(os.path.join(store_dir, HEADER_FILE), 'r') as f:
+            header = json.load(f)
+
+        self.dim = header['dim']
+        self.count = header['count']
+        self._matrix = np.load(os.path.join(store_dir, VECTORS_FILE), mmap_mode=mode)
+        self._records = None
+        self._path_to_id = None
+
+        if mode == 'r+':
+            self._truncate_paths()
+
+
+    def _truncate_paths(self):
+        """
+        Drop the path records past `count`, left by an append that crashed before rewriting the header,
+        so that the next append writes its records next to the rows of their vectors
+        """
+        paths_file = os.path.join(self.store_dir, PATHS_FILE)
+
+        with open(paths_file, 'rb+') as f:
+            for _ in range(self.count):
+                if not f.readline():
+                    return
+            if f.tell() < os.fstat(f.fileno()).st_size:
+                f.truncate()
+
+
+    @classmethod
+    def create(cls, store_dir, dim, capacity = MIN_CAPACITY):
+        """
+        Create an empty store in store_dir and open it for appending
+        """
+        os.makedirs(store_dir, exist_ok=True)
+
+        matrix = np.lib.format.open_memmap(os.path.join(store_dir, VECTORS_FILE), mode='w+',
+                                           dtype=np.float32, shape=(max(capacity, 1), dim))
+        del matrix
+
+        open(os.path.join(store_dir, PATHS_FILE), 'w').close()
+        cls._write_header(store_dir, dim, 0)
+
+        return cls(store_dir, mode='r+')
+
+
+    @classmethod
+    def open(cls, store_dir, dim = None, mode = 'r'):
+        """
+        Open an existing store, or create it when it doesn't exist and dim is given
+        """
+        if not os.path.exists(os.path.join(store_dir, HEADER_FILE)):
+            if dim is None:
+                raise FileNotFoundError(f"No embedding store in {store_dir}")
+            return cls.create(store_dir, dim)
+
+        return cls(store_dir, mode=mode)
+
+
+    @staticmethod
+    def _write_header(store_dir, dim, count):
+        tmp_file = os.path.join(store_dir, HEADER_FILE + '.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump({'dim': dim, 'count': count, 'dtype': 'float32'}, f)
+        os.replace(tmp_file, os.path.join(store_dir, HEADER_FILE))
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __contains__(self, path):
+        return path in self.path_to_id
+
+
+    @property
+    def vectors(self):
+        """
+        Memory-mapped (count, dim) float32 view of the stored embeddings
+        """
+        return self._matrix[:self.count]
+
+
+    @property
+    def records(self):
+        if self._records is None:
+            with open(os.path.join(self.store_dir, PATHS_FILE), 'r') as f:
+                # lines past `count` belong to an unfinished append, they may be cut mid-record
+                self._records = [json.loads(line) for line in itertools.islice(f, self.count)]
+        return self._records
+
+
+    @property
+    def paths(self):
+        return [r['path'] for r in self.records]
+
+
+    @property
+    def path_to_id(self):
+        if self._path_to_id is None:
+            self._path_to_id = {r['path']: i for i, r in enumerate(self.records)}
+        return self._path_to_id
+
+
+    def get(self, path, default = None):
+        """
+        Get the embedding of an image path, or default if the path isn't in the store
+        """
+        idx = self.path_to_id.get(path)
+        if idx is None:
+            return default
+        return self._matrix[idx]
+
+
+    def get_metadata(self, path):
+        idx = self.path_to_id.get(path)
+        if idx is None:
+            return None
+        return self.records[idx]
+
+
+    def _grow(self, min_capacity):
+        capacity = max(min_capacity, 2 * self._matrix.shape[0], MIN_CAPACITY)
+
+        vectors_file = os.path.join(self.store_dir, VECTORS_FILE)
+        tmp_file = os.path.join(self.store_dir, VECTORS_FILE + '.tmp')
+
+        matrix = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(capacity, self.dim))
+        matrix[:self.count] = self._matrix[:self.count]
+        matrix.flush()
+        del matrix
+
+        self._matrix = None
+        os.replace(tmp_file, vectors_file)
+        self._matrix = np.load(vectors_file, mmap_mode='r+')
+
+
+    def append(self, paths, embeddings, metadata = None):
+        """
+        Append embeddings for a list of image paths. metadata is an optional list of dicts stored with each path.
+        Returns the row ids of the new embeddings.
+        """
+        if self.mode != 'r+':
+            raise PermissionError("Embedding store was opened read-only, use mode='r+' to append")
+
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        if len(paths) != len(embeddings):
+            raise ValueError(f"Got {len(embeddings)} embeddings for {len(paths)} paths")
+        if metadata is None:
+            metadata = [{}] * len(paths)
+
+        start = self.count
+        end = start + len(paths)
+        if end > self._matrix.shape[0]:
+            self._grow(end)
+
+        self._matrix[start:end] = embeddings
+        self._matrix.flush()
+
+        new_records = [{**m, 'path': p} for p, m in zip(paths, metadata)]
+        with open(os.path.join(self.store_dir, PATHS_FILE), 'a') as f:
+            for r in new_records:
+                f.write(json.dumps(r) + '\n')
+
+        self.count = end
+        self._write_header(self.store_dir, self.dim, self.count)
+
+        if self._records is not None:
+            self._records.extend(new_records)
+        if self._path_to_id is not None:
+            for i, r in enumerate(new_records):
+                self._path_to_id[r['path']] = start + i
+
+        return list(range(start, end))
+
+
+    def flush(self):
+        if self.mode == 'r+':
+            self._matrix.flush()
+
+
+
+def convert_pkl_to_store(pkl_file, store_dir, path_column = 'file', embedding_column = 'embedding'):
+    """
+    One-shot conversion of a pickled embeddings file (see utils.save_obj_to_pkl) to an EmbeddingStore.
+
+    Supported pickle contents:
+        - a DataFrame with a path column and an embedding column, other columns are kept as metadata
+        - a dict of {path: embedding}
+        - a list of (path, embedding) pairs
+    """
+    with open(pkl_file, 'rb') as f:
+        obj = pickle.load(f)
+
+    if hasattr(obj, 'columns'):
+        meta_columns = [c for c in obj.columns if c not in (path_column, embedding_column)]
+        paths = obj[path_column].tolist()
+        embeddings = obj[embedding_column].tolist()
+        metadata = obj[meta_columns].to_dict('records')
+    elif isinstance(obj, dict):
+        paths = list(obj.keys())
+        embeddings = list(obj.values())
+        metadata = None
+    else:
+        paths = [p for p, _ in obj]
+        embeddings = [e for _, e in obj]
+        metadata = None
+
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    store = EmbeddingStore.create(store_dir, dim=embeddings.shape[1], capacity=len(paths))
+    store.append(paths, embeddings, metadata)
+
+    return store
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a pickled embeddings file to a memory-mapped embedding store")
+    parser.add_argument('pkl_file', help="Pickle file, e.g. image-embeddings/men-women-animals-embeddings.pkl")
+    parser.add_argument('store_dir', help="Output directory of the embedding store")
+    parser.add_argument('--path_column', default='file')
+    parser.add_argument('--embedding_column', default='embedding')
+    args = parser.parse_args()
+
+    store = convert_pkl_to_store(args.pkl_file, args.store_dir, args.path_column, args.embedding_column)
+    print(f"Converted {len(store)} embeddings of dimension {store.dim} to {args.store_dir}")
@@ -0,0 +1,221 @@
+import os
+import io
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+
+DEFAULT_MAX_SIDE = 2048
+DEFAULT_QUALITY = 85
+DEFAULT_CACHE_DIR = os.getenv("SHRUNK_IMAGE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "gen-cv", "shrunk-images"))
+DEFAULT_MAX_MEMORY_ITEMS = 256
+DEFAULT_MAX_DISK_BYTES = 1024 ** 3
+
+## cached in place of the image bytes when the original is uploaded as it is (already small enough, or not smaller shrunk)
+USE_ORIGINAL = b''
+
+## images smaller than this are uploaded as they are
+MIN_SHRINK_BYTES = 512 * 1024
+
+## shrinking is opt-in, per call (shrink=True) or for the process with configure_image_shrinker(enabled=True)
+SHRINK_IMAGES = os.getenv("SHRINK_IMAGES", "0") == "1"
+
+
+
+class ImageShrinker:
+    """
+    Downsizes images before they are uploaded to the Vision APIs, which downsample internally anyway.
+
+    The image is decoded once (JPEG files are decoded directly at a reduced scale), resized so that its
+    longest side is at most max_side and re-encoded as JPEG at the given quality. Shrunk bytes are cached
+    by the hash of the original bytes, in memory and in cache_dir; images that don't get smaller are cached as
+    a USE_ORIGINAL marker rather than a copy. The files of cache_dir are evicted least-recently-used first once
+    they grow above max_disk_bytes. Safe to share between threads.
+    """
+
+    def __init__(self, max_side = DEFAULT_MAX_SIDE,
+                       quality = DEFAULT_QUALITY,
+                       cache_dir = DEFAULT_CACHE_DIR,
+                       max_memory_items = DEFAULT_MAX_MEMORY_ITEMS,
+                       max_disk_bytes = DEFAULT_MAX_DISK_BYTES):
+
+        self.max_side = max_side
+        self.quality = quality
+        self.cache_dir = cache_dir
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk_bytes = 0
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.disk_bytes = sum(size for _, size, _ in self.list_cache_files())
+
+
+    def get_key(self, data):
+        return f"{hashlib.sha256(data).hexdigest()}-{self.max_side}-q{self.quality}"
+
+
+    def list_cache_files(self):
+        """
+        (path, size, last access) of the files of cache_dir
+        """
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith('.jpg'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((entry.path, stat.st_size, stat.st_mtime))
+        return files
+
+
+    def get_cached(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + '.jpg')
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                # the modification time is the last access of the file for the eviction
+                os.utime(path)
+                return data
+            except FileNotFoundError:
+                pass
+
+        return None
+
+
+    def put_cached(self, key, data):
+        with self.lock:
+            self.memory[key] = data
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_memory_items:
+                self.memory.popitem(last=False)
+
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + '.jpg')
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+            with self.lock:
+                self.disk_bytes += len(data)
+                if self.disk_bytes > self.max_disk_bytes:
+                    self.evict()
+
+
+    def evict(self):
+        """
+        Delete the least recently used files of cache_dir down to 90% of max_disk_bytes. Called with the lock held.
+        """
+        files = sorted(self.list_cache_files(), key=lambda file: file[2])
+        self.disk_bytes = sum(size for _, size, _ in files)
+        target = int(self.max_disk_bytes * 0.9)
+
+        for path, size, _ in files:
+            if self.disk_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.disk_bytes -= size
+
+
+    def resize(self, data):
+        """
+        Decoded, downsized and re-encoded image, or None when the image is already small enough
+        """
+        image = Image.open(io.BytesIO(data))
+
+        if max(image.size) <= self.max_side:
+            return None
+
+        # lets the JPEG decoder skip straight to the smallest 1/2, 1/4 or 1/8 scale above the target size
+        image.draft('RGB', (self.max_side, self.max_side))
+        image = ImageOps.exif_transpose(image)
+
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        image.thumbnail((self.max_side, self.max_side), Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+        out = io.BytesIO()
+        image.save(out, format='JPEG', quality=self.quality)
+        return out.getvalue()
+
+
+    def shrink(self, data):
+        """
+        Bytes to upload for an image: the shrunk JPEG when it is smaller, else the original bytes
+        """
+        if len(data) < MIN_SHRINK_BYTES:
+            return data
+
+        key = self.get_key(data)
+        shrunk = self.get_cached(key)
+
+        if shrunk is None:
+            try:
+                shrunk = self.resize(data)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Could not shrink image, uploading the original bytes: {e}")
+                return data
+
+            if (shrunk is None) or (len(shrunk) >= len(data)):
+                shrunk = USE_ORIGINAL
+            self.put_cached(key, shrunk)
+
+        return data if shrunk == USE_ORIGINAL else shrunk
+
+
+
+_default_shrinker = None
+_default_shrinker_lock = threading.Lock()
+
+
+def get_image_shrinker():
+    global _default_shrinker
+
+    with _default_shrinker_lock:
+        if _default_shrinker is None:
+            _default_shrinker = ImageShrinker()
+    return _default_shrinker
+
+
+def configure_image_shrinker(max_side = DEFAULT_MAX_SIDE, quality = DEFAULT_QUALITY, cache_dir = DEFAULT_CACHE_DIR, enabled = True):
+    """
+    Replace the process-wide ImageShrinker, and turn shrinking on (or off) for the calls that don't pass shrink
+    """
+    global _default_shrinker, SHRINK_IMAGES
+
+    with _default_shrinker_lock:
+        _default_shrinker = ImageShrinker(max_side, quality, cache_dir)
+        SHRINK_IMAGES = enabled
+    return _default_shrinker
+
+
+def read_image_file(filename, shrink = None):
+    """
+    Bytes of an image file to upload to the Vision APIs, shrunk when shrink is True
+    (shrink=None follows configure_image_shrinker / the SHRINK_IMAGES environment variable)
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    if SHRINK_IMAGES if shrink is None else shrink:
+        data = get_image_shrinker().shrink(data)
+
+    return data
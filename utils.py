@@ -8,8 +8,12 @@ from io import BytesIO
 import matplotlib.pyplot as plt
 import azure.ai.vision as sdk
 import pickle
+import numpy as np
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 import openai
+from embedding_store import EmbeddingStore
+from embedding_cache import get_embedding_cache, image_key, text_key
+from image_preprocessing import read_image_file
 
 # Central variables image search:
 load_dotenv('../.env')
@@ -98,9 +102,10 @@ def show_images(images, cols=2, source='url', savedir='', show_title=False, titl
 
 
 @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6)) # automatic retry in case of a failing API call
-def get_embedding(imagefile):
+def get_embedding(imagefile, shrink = None):
     """
-    Get embedding from an image using Azure Computer Vision 4
+    Get embedding from an image using Azure Computer Vision 4.
+    With shrink, the image is downsized before the upload (see image_preprocessing.read_image_file)
     """
     # settings
     model = "?api-version=2023-02-01-preview&modelVersion=latest"
@@ -111,13 +116,15 @@ def get_embedding(imagefile):
     }
 
     # Read the image file
-    with open(imagefile, "rb") as f:
-        data = f.read()
+    data = read_image_file(imagefile, shrink)
 
-    # Sending the requests
-    r = requests.post(url, data=data, headers=headers)
-    results = r.json()
-    embeddings = results['vector']
+    # Sending the requests, unless these image bytes were already embedded
+    def vectorize():
+        r = requests.post(url, data=data, headers=headers)
+        results = r.json()
+        return results['vector']
+
+    embeddings = get_embedding_cache().get_or_compute(image_key(data), vectorize)
 
     return embeddings
 
@@ -141,10 +148,13 @@ def get_text_embedding(text):
         "text": text
     }
 
-    # Sending the requests
-    r = requests.post(url, data=json.dumps(data), headers=headers)
-    results = r.json()
-    embeddings = results['vector']
+    # Sending the requests, unless this text was already embedded
+    def vectorize():
+        r = requests.post(url, data=json.dumps(data), headers=headers)
+        results = r.json()
+        return results['vector']
+
+    embeddings = get_embedding_cache().get_or_compute(text_key(text), vectorize)
 
     return embeddings
 
@@ -198,6 +208,18 @@ def save_obj_to_pkl(object, filename):
 
 
 
+def save_embeddings_to_store(paths, embeddings, store_dir, metadata = None):
+    """
+    Append embeddings to the memory-mapped EmbeddingStore in store_dir, creating it if needed.
+    Use instead of save_obj_to_pkl for embedding sets, the store opens without loading the vectors.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    store = EmbeddingStore.open(store_dir, dim=embeddings.shape[-1], mode='r+')
+    store.append(paths, embeddings, metadata)
+    return store
+
+
+
 @retry(wait=wait_random_exponential(min=1, max=5), stop=stop_after_attempt(7))
 def chat_openai(prompt, completion_model, max_output_tokens = 500):
 